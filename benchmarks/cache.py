@@ -0,0 +1,132 @@
+# benchmarks/cache.py
+
+"""
+Message Manager - A bot for discord
+Copyright (C) 2020-2021 AnotherCat
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Compares the array backed LFU engine against the old linked list one.
+
+Run with `python -m benchmarks.cache` from the project root (the bot's config
+must be loadable, eg inside the docker container).
+"""
+
+import argparse
+import asyncio
+import gc
+import random
+import time
+import tracemalloc
+
+from typing import Any, Callable, Coroutine, Dict, List, Type
+
+from benchmarks.legacy_lfu import BaseLFUCache as LegacyLFUCache
+from src.cache import BaseLFUCache
+
+IMPLEMENTATIONS: Dict[str, Type[Any]] = {
+    "array": BaseLFUCache,
+    "linked": LegacyLFUCache,
+}
+
+
+def skewed_keys(amount: int, key_space: int, seed: int = 0) -> List[int]:
+    # A few guilds are much busier than the rest, like real traffic
+    rnd = random.Random(seed)
+    return [int(rnd.paretovariate(1.2)) % key_space for _ in range(amount)]
+
+
+async def get_workload(cache: Any, keys: List[int]) -> None:
+    for key in keys:
+        await cache.get(key)
+
+
+async def set_workload(cache: Any, keys: List[int]) -> None:
+    for key in keys:
+        cache.set(key, key)
+
+
+def fill(cache: Any, capacity: int) -> None:
+    for key in range(capacity):
+        cache.set(key, key)
+
+
+def run_timed(
+    workload: Callable[[Any, List[int]], Coroutine[Any, Any, None]],
+    cache: Any,
+    keys: List[int],
+) -> float:
+    gc.collect()
+    start = time.perf_counter()
+    asyncio.run(workload(cache, keys))
+    return time.perf_counter() - start
+
+
+def memory_used(cls: Type[Any], capacity: int, drop_amount: int) -> int:
+    gc.collect()
+    tracemalloc.start()
+    cache = cls(capacity, drop_amount)
+    fill(cache, capacity)
+    asyncio.run(get_workload(cache, skewed_keys(capacity, capacity)))
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current
+
+
+def gc_time(cls: Type[Any], capacity: int, drop_amount: int) -> float:
+    cache = cls(capacity, drop_amount)
+    fill(cache, capacity)
+    start = time.perf_counter()
+    gc.collect()
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare the LFU cache engines")
+    parser.add_argument("--capacity", type=int, default=100_000)
+    parser.add_argument("--drop", type=int, default=1_000)
+    parser.add_argument("--operations", type=int, default=500_000)
+    args = parser.parse_args()
+
+    hit_keys = skewed_keys(args.operations, args.capacity)
+    # Keys that are never in the cache, every get is a fetch, set and an eviction
+    miss_keys = list(range(args.capacity, args.capacity + args.operations))
+
+    print(f"capacity={args.capacity} drop={args.drop} operations={args.operations}\n")
+    print(f"{'engine':<8}{'workload':<10}{'total (s)':>12}{'ns/op':>12}")
+    for name, cls in IMPLEMENTATIONS.items():
+        for workload_name, workload, keys in (
+            ("hit", get_workload, hit_keys),
+            ("miss", get_workload, miss_keys),
+            ("eviction", set_workload, miss_keys),
+        ):
+            cache = cls(args.capacity, args.drop)
+            fill(cache, args.capacity)
+            total = run_timed(workload, cache, keys)
+            print(
+                f"{name:<8}{workload_name:<10}{total:>12.3f}"
+                f"{total / len(keys) * 1e9:>12.0f}"
+            )
+    print()
+    for name, cls in IMPLEMENTATIONS.items():
+        used = memory_used(cls, args.capacity, args.drop)
+        collect = gc_time(cls, args.capacity, args.drop)
+        print(
+            f"{name:<8}memory for {args.capacity} entries: {used / 1024:.0f} KiB, "
+            f"full gc.collect(): {collect * 1000:.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
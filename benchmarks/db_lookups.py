@@ -0,0 +1,142 @@
+# benchmarks/db_lookups.py
+
+"""
+Message Manager - A bot for discord
+Copyright (C) 2020-2021 AnotherCat
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Compares the prepared statement queries in src.models against the ORM ones.
+
+Run with `python -m benchmarks.db_lookups` from the project root, inside the
+docker container so the database in the bot's config is used. `--db-url` runs it
+against another database instead, on anything but postgres both sides use the
+ORM. The rows it makes are in an id range of their own and are deleted after.
+"""
+
+import argparse
+import asyncio
+import gc
+import time
+
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from tortoise import Tortoise
+
+from src import models
+
+FIRST_ID = 9_000_000_000_000_000_000  # Far above any real snowflake
+LOGGER_TYPE = "main"
+
+Lookup = Callable[[int], Awaitable[Any]]
+
+
+def lookups(raw: bool) -> Dict[str, Lookup]:
+    if raw:
+        return {
+            "guilds": lambda key: models.fetch_guild_rows([key, key + 1]),
+            "logging_channel": lambda key: models.fetch_logging_channel_row(
+                key, LOGGER_TYPE
+            ),
+            "channel_webhook": models.fetch_channel_webhook_row,
+            "update_prefix": lambda key: models.update_guild_row(key, "prefix", "~"),
+        }
+    return {
+        "guilds": lambda key: models.fetch_guild_rows_orm([key, key + 1]),
+        "logging_channel": lambda key: models.fetch_logging_channel_row_orm(
+            key, LOGGER_TYPE
+        ),
+        "channel_webhook": models.fetch_channel_webhook_row_orm,
+        "update_prefix": lambda key: models.update_guild_row_orm(key, "prefix", "~"),
+    }
+
+
+async def seed(rows: int) -> List[int]:
+    keys = list(range(FIRST_ID, FIRST_ID + rows))
+    await models.Guild.bulk_create(
+        [models.Guild(id=key, management_role_id=None, prefix="~") for key in keys]
+    )
+    await models.Channel.bulk_create(
+        [models.Channel(id=key, webhook_id=key, webhook_token="token") for key in keys]
+    )
+    await models.LoggingChannel.bulk_create(
+        [
+            models.LoggingChannel(guild_id=key, channel_id=key, logger_type=LOGGER_TYPE)
+            for key in keys
+        ]
+    )
+    return keys
+
+
+async def clean_up() -> None:
+    await models.LoggingChannel.filter(guild_id__gte=FIRST_ID).delete()
+    await models.Channel.filter(id__gte=FIRST_ID).delete()
+    await models.Guild.filter(id__gte=FIRST_ID).delete()
+
+
+async def run_timed(lookup: Lookup, keys: List[int], operations: int) -> float:
+    gc.collect()
+    start = time.perf_counter()
+    for index in range(operations):
+        await lookup(keys[index % len(keys)])
+    return time.perf_counter() - start
+
+
+async def run(db_url: Optional[str], rows: int, operations: int) -> None:
+    if db_url is not None:
+        await Tortoise.init(db_url=db_url, modules={"bot": ["src.models"]})
+        await Tortoise.generate_schemas()
+    else:
+        from tortoise_config import TORTOISE_ORM
+
+        await Tortoise.init(config=TORTOISE_ORM)
+    client = Tortoise.get_connection("default")
+    print(f"backend={type(client).__name__} rows={rows} operations={operations}")
+    if models.asyncpg_client() is None:
+        print("Not postgres, the prepared side falls back to the ORM")
+    print()
+
+    try:
+        await clean_up()  # From a run that was stopped
+        keys = await seed(rows)
+        print(f"{'lookup':<18}{'implementation':<16}{'ops/s':>10}{'us/op':>10}")
+        for raw in (False, True):
+            # Once through first, so both sides start with warm connections
+            for lookup in lookups(raw).values():
+                await run_timed(lookup, keys, min(operations, len(keys)))
+        for name in lookups(False):
+            for raw in (False, True):
+                total = await run_timed(lookups(raw)[name], keys, operations)
+                print(
+                    f"{name:<18}{'prepared' if raw else 'orm':<16}"
+                    f"{operations / total:>10.0f}{total / operations * 1e6:>10.1f}"
+                )
+    finally:
+        await clean_up()
+        await Tortoise.close_connections()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Compare the prepared statement lookups against the ORM"
+    )
+    parser.add_argument("--db-url", default=None)
+    parser.add_argument("--rows", type=int, default=1_000)
+    parser.add_argument("--operations", type=int, default=10_000)
+    args = parser.parse_args()
+    asyncio.run(run(args.db_url, args.rows, args.operations))
+
+
+if __name__ == "__main__":
+    main()
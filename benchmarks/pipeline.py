@@ -0,0 +1,466 @@
+# benchmarks/pipeline.py
+
+"""
+Message Manager - A bot for discord
+Copyright (C) 2020-2021 AnotherCat
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Throughput and latency of the whole command pipeline, without discord.
+
+Synthetic MESSAGE_CREATE and INTERACTION_CREATE payloads are fed straight into
+the bot's gateway parsers. discord.py's HTTP client and the request scheduler's
+backend are replaced with fakes that answer instantly, and the database is an
+in memory SQLite one. When a confirm prompt is sent the fake backend clicks
+its confirm button, so the send and edit commands run all the way through.
+
+Run with `python -m benchmarks.pipeline` from the project root. The config
+variables that are needed get placeholder values if they aren't set. Use
+`--json` to save the results and compare them between commits.
+"""
+
+import os
+
+# Before anything imports load_config
+for name, value in (
+    ("DISCORD_TOKEN", "benchmark"),
+    ("POSTGRES_USER", "benchmark"),
+    ("POSTGRES_PASSWORD", "benchmark"),
+    ("POSTGRES_DB", "benchmark"),
+    ("BOT_OWNERS", "1"),
+    ("BOT_SELFHOST", "True"),
+):
+    os.environ.setdefault(name, value)
+
+import argparse  # noqa: E402
+import asyncio  # noqa: E402
+import gc  # noqa: E402
+import itertools  # noqa: E402
+import json  # noqa: E402
+import logging  # noqa: E402
+import platform  # noqa: E402
+import re  # noqa: E402
+import statistics  # noqa: E402
+import subprocess  # noqa: E402
+import time  # noqa: E402
+import tracemalloc  # noqa: E402
+
+from typing import Any, Callable, Dict, List, Optional  # noqa: E402
+
+import aiohttp  # noqa: E402
+import discord  # noqa: E402
+
+from discord.http import HTTPClient, Route  # noqa: E402
+from tortoise import Tortoise  # noqa: E402
+
+import src  # noqa: E402, F401 (src has to be imported before main)
+
+from main import Bot, get_custom_prefix  # noqa: E402
+from src.custom_ids import decode_custom_id  # noqa: E402
+from src.http_scheduler import (  # noqa: E402
+    FakeHTTPBackend,
+    FakeRequest,
+    HTTPResponse,
+    HTTPScheduler,
+)
+
+GUILD_ID = 800000000000000000
+CHANNEL_ID = 800000000000000001
+AUTHOR_ID = 800000000000000002
+BOT_ID = 800000000000000003
+TIMESTAMP = "2021-01-01T00:00:00+00:00"
+
+BOT_USER = {
+    "id": str(BOT_ID),
+    "username": "Message Manager",
+    "discriminator": "0001",
+    "avatar": None,
+    "bot": True,
+}
+AUTHOR = {
+    "id": str(AUTHOR_ID),
+    "username": "Author",
+    "discriminator": "0002",
+    "avatar": None,
+}
+MEMBER = {"roles": [], "joined_at": TIMESTAMP, "deaf": False, "mute": False}
+GUILD = {
+    "id": str(GUILD_ID),
+    "name": "Benchmark",
+    "owner_id": str(AUTHOR_ID),  # The owner passes the management role check
+    "region": "us-west",
+    "verification_level": 0,
+    "features": [],
+    "emojis": [],
+    "member_count": 2,
+    "roles": [
+        {
+            "id": str(GUILD_ID),
+            "name": "@everyone",
+            # Administrator, so the bot can send and embed, v7 reads permissions_new
+            "permissions": "8",
+            "permissions_new": "8",
+            "position": 0,
+            "color": 0,
+            "hoist": False,
+            "managed": False,
+            "mentionable": False,
+        }
+    ],
+    "channels": [
+        {
+            "id": str(CHANNEL_ID),
+            "type": 0,
+            "name": "general",
+            "position": 0,
+            "permission_overwrites": [],
+        }
+    ],
+    "members": [{"user": AUTHOR, **MEMBER}, {"user": BOT_USER, **MEMBER}],
+}
+SQLITE_CONFIG = {
+    "connections": {"default": "sqlite://:memory:"},
+    "apps": {"bot": {"models": ["src.models"], "default_connection": "default"}},
+}
+MESSAGE_URL = re.compile(r"/channels/(\d+)/messages(?:/(\d+))?$")
+
+
+def message_payload(
+    message_id: int, author: Dict[str, Any], content: str, **extra: Any
+) -> Dict[str, Any]:
+    return {
+        "id": str(message_id),
+        "channel_id": str(CHANNEL_ID),
+        "guild_id": str(GUILD_ID),
+        "author": author,
+        "member": MEMBER,
+        "content": content,
+        "timestamp": TIMESTAMP,
+        "edited_timestamp": None,
+        "tts": False,
+        "mention_everyone": False,
+        "mentions": [],
+        "mention_roles": [],
+        "attachments": [],
+        "embeds": [],
+        "pinned": False,
+        "type": 0,
+        **extra,
+    }
+
+
+class FakeDiscordHTTP(HTTPClient):
+    # discord.py's requests, eg ctx.send and fetch_message, answered locally
+
+    def __init__(self, harness: "Harness") -> None:
+        super().__init__()
+        self.harness = harness
+        self.requests = 0
+
+    async def request(self, route: Route, *, files: Any = None, form: Any = None, **kwargs: Any) -> Any:  # type: ignore[override]
+        self.requests += 1
+        match = MESSAGE_URL.search(route.url)
+        if match is None:
+            return {}
+        payload = kwargs.get("json") or {}
+        if route.method == "POST":
+            return message_payload(
+                self.harness.next_id(),
+                BOT_USER,
+                payload.get("content") or "",
+                embeds=[payload["embed"]] if payload.get("embed") else [],
+            )
+        # Fetching or editing one of the bot's messages
+        return message_payload(
+            int(match.group(2)), BOT_USER, payload.get("content") or "Old content"
+        )
+
+
+class Harness:
+    def __init__(self, bot: Bot) -> None:
+        self.bot = bot
+        self.ids = itertools.count(GUILD_ID + 1000)
+        self.loop = bot.loop
+        # {message or interaction id: future}, resolved when it's been handled
+        self.pending: Dict[int, "asyncio.Future[float]"] = {}
+        self.clicked_at: Dict[int, float] = {}
+        self.backend = FakeHTTPBackend(handler=self.handle_request)
+        self.http = FakeDiscordHTTP(self)
+
+    def next_id(self) -> int:
+        return next(self.ids)
+
+    def handle_request(self, request: FakeRequest) -> HTTPResponse:
+        # Requests from the scheduler, interaction responses and confirm prompts
+        if request.url.endswith("/callback"):
+            return HTTPResponse(204, "", {}, None)
+        payload = json.loads(request.data) if request.data else {}
+        match = MESSAGE_URL.search(request.url)
+        if match is not None and request.method == "POST":
+            message_id = self.next_id()
+            for row in payload.get("components") or []:
+                for component in row["components"]:
+                    data = decode_custom_id(component.get("custom_id", ""))
+                    if data is not None and data.action == "confirm":
+                        self.loop.call_soon(
+                            self.click, component["custom_id"], message_id, data
+                        )
+            return HTTPResponse(200, "", {}, message_payload(message_id, BOT_USER, ""))
+        return HTTPResponse(200, "", {}, message_payload(self.next_id(), BOT_USER, ""))
+
+    def click(self, custom_id: str, message_id: int, data: Any) -> None:
+        self.clicked_at[data.message_id] = time.perf_counter()
+        self.bot._connection.parsers["INTERACTION_CREATE"](  # type: ignore
+            {
+                "id": str(self.next_id()),
+                "application_id": str(BOT_ID),
+                "type": 3,
+                "token": "benchmark",
+                "version": 1,
+                "guild_id": str(GUILD_ID),
+                "channel_id": str(CHANNEL_ID),
+                "member": {"user": AUTHOR, "permissions": "8", **MEMBER},
+                "message": message_payload(message_id, BOT_USER, ""),
+                "data": {"custom_id": custom_id, "component_type": 2},
+            }
+        )
+
+    def finished(self, key: int) -> None:
+        future = self.pending.get(key)
+        if future is not None and not future.done():
+            future.set_result(time.perf_counter())
+
+    async def setup(self) -> None:
+        bot = self.bot
+        bot.http = bot._connection.http = self.http
+        bot._connection.user = discord.ClientUser(  # type: ignore
+            state=bot._connection, data=BOT_USER
+        )
+        bot._connection._add_guild_from_data(GUILD)  # type: ignore
+        bot.session = aiohttp.ClientSession()
+        # No global limit, so the fake backend is what's measured
+        bot.http_scheduler = HTTPScheduler(
+            self.backend, token="benchmark", global_limit=1_000_000
+        )
+        await bot.init_db(tortoise_config=SQLITE_CONFIG)
+        await Tortoise.generate_schemas()
+        bot.load_extension("cogs.messages")
+        bot.load_extension("cogs.maincog")
+
+    async def close(self) -> None:
+        await self.bot.analytics.close()
+        await self.bot.session.close()
+        await Tortoise.close_connections()
+
+    def message_event(self, content: str) -> Callable[[int], None]:
+        def inject(message_id: int) -> None:
+            self.bot._connection.parsers["MESSAGE_CREATE"](  # type: ignore
+                message_payload(message_id, AUTHOR, content)
+            )
+
+        return inject
+
+    def slash_event(self, name: str, sub_command: str) -> Callable[[int], None]:
+        def inject(interaction_id: int) -> None:
+            self.bot._connection.parsers["INTERACTION_CREATE"](  # type: ignore
+                {
+                    "id": str(interaction_id),
+                    "application_id": str(BOT_ID),
+                    "type": 2,
+                    "token": "benchmark",
+                    "version": 1,
+                    "guild_id": str(GUILD_ID),
+                    "channel_id": str(CHANNEL_ID),
+                    "member": {"user": AUTHOR, "permissions": "8", **MEMBER},
+                    "data": {
+                        "id": "1",
+                        "name": name,
+                        "options": [{"name": sub_command, "type": 1}],
+                    },
+                }
+            )
+
+        return inject
+
+    async def run_event(self, inject: Callable[[int], None]) -> Dict[str, float]:
+        event_id = self.next_id()
+        future = self.loop.create_future()
+        self.pending[event_id] = future
+        start = time.perf_counter()
+        inject(event_id)
+        finished_at = await asyncio.wait_for(future, timeout=30)
+        del self.pending[event_id]
+        timings = {"total": finished_at - start}
+        # Confirm prompts are keyed by the message of the command
+        clicked_at = self.clicked_at.pop(event_id, None)
+        if clicked_at is not None:
+            timings["confirm"] = finished_at - clicked_at
+        return timings
+
+    async def run_flow(
+        self, inject: Callable[[int], None], events: int, concurrency: int
+    ) -> Dict[str, Any]:
+        semaphore = asyncio.Semaphore(concurrency)
+        results: List[Dict[str, float]] = []
+
+        async def one() -> None:
+            async with semaphore:
+                results.append(await self.run_event(inject))
+
+        gc.collect()
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(events)))
+        elapsed = time.perf_counter() - start
+        report: Dict[str, Any] = {"events_per_second": events / elapsed}
+        for timing in ("total", "confirm"):
+            values = sorted(result[timing] for result in results if timing in result)
+            if len(values) > 0:
+                report[f"{timing}_p50_ms"] = statistics.median(values) * 1000
+                report[f"{timing}_p99_ms"] = (
+                    values[min(len(values) - 1, int(len(values) * 0.99))] * 1000
+                )
+        return report
+
+    async def measure_memory(
+        self, inject: Callable[[int], None], events: int
+    ) -> Dict[str, float]:
+        # Run one at a time, so the peak is what a single event needs
+        gc.collect()
+        tracemalloc.start()
+        before, _ = tracemalloc.get_traced_memory()
+        for _ in range(events):
+            await self.run_event(inject)
+        gc.collect()
+        after, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {
+            "retained_bytes_per_event": (after - before) / events,
+            "peak_kib": (peak - before) / 1024,
+        }
+
+
+class BenchmarkBot(Bot):
+    # Tells the harness when an event has been handled all the way through
+    harness: Harness
+
+    async def process_commands(self, message: discord.Message) -> None:
+        await super().process_commands(message)
+        self.harness.finished(message.id)
+
+    async def on_command_interaction(self, interaction: Any) -> None:
+        await super().on_command_interaction(interaction)
+        self.harness.finished(interaction.id)
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def run(harness: Harness, args: argparse.Namespace) -> Dict[str, Any]:
+    await harness.setup()
+    flows = {
+        "chat": harness.message_event("Just a normal message, not a command"),
+        "send": harness.message_event(f"~send <#{CHANNEL_ID}> Some new content"),
+        "edit": harness.message_event(
+            f"~edit <#{CHANNEL_ID}> {GUILD_ID + 1} Some edited content"
+        ),
+        "slash": harness.slash_event("info", "ping"),
+    }
+    results: Dict[str, Any] = {}
+    try:
+        for name, inject in flows.items():
+            if args.flows and name not in args.flows:
+                continue
+            await harness.run_flow(inject, args.warmup, args.concurrency)
+            results[name] = await harness.run_flow(
+                inject, args.events, args.concurrency
+            )
+            results[name].update(
+                await harness.measure_memory(inject, args.memory_events)
+            )
+    finally:
+        await harness.close()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the command pipeline")
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--warmup", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--memory-events", type=int, default=200)
+    parser.add_argument(
+        "--flows", nargs="*", help="Only run these flows (chat, send, edit, slash)"
+    )
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    bot = BenchmarkBot(
+        owner_ids=[1],
+        default_prefix="~",
+        self_hosted=True,
+        command_prefix=get_custom_prefix,
+        shard_count=1,
+    )
+    harness = Harness(bot)
+    bot.harness = harness
+    results = bot.loop.run_until_complete(run(harness, args))
+
+    revision = git_revision()
+    print(
+        f"revision={revision} python={platform.python_version()} "
+        f"events={args.events} concurrency={args.concurrency}\n"
+    )
+    columns = (
+        ("events/s", "events_per_second", 0),
+        ("p50 ms", "total_p50_ms", 2),
+        ("p99 ms", "total_p99_ms", 2),
+        ("confirm p50", "confirm_p50_ms", 2),
+        ("confirm p99", "confirm_p99_ms", 2),
+        ("B/event", "retained_bytes_per_event", 0),
+        ("peak KiB", "peak_kib", 0),
+    )
+    print(f"{'flow':<8}" + "".join(f"{title:>13}" for title, _, _ in columns))
+    for name, result in results.items():
+        row = f"{name:<8}"
+        for _, key, digits in columns:
+            value: Optional[float] = result.get(key)
+            row += f"{value:>13.{digits}f}" if value is not None else f"{'-':>13}"
+        print(row)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "revision": revision,
+                    "python": platform.python_version(),
+                    "args": vars(args),
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
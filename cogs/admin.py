@@ -20,6 +20,7 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import asyncio
 import datetime
+import io
 import logging
 import random
 import string
@@ -32,7 +33,7 @@ import discord
 from discord.ext import commands
 
 from main import Bot
-from src import Context, errors
+from src import Context, errors, metrics
 
 if TYPE_CHECKING:
     Cog = commands.Cog[Context]
@@ -164,6 +165,19 @@ class AdminCog(Cog):
             )
         )
 
+    @commands.command(name="metrics", hidden=True)
+    async def _metrics(self, ctx: Context) -> None:
+        lines = metrics.registry.summary()
+        if not metrics.registry.enabled:
+            lines.insert(0, "Timings are off, set METRICS_ENABLED to keep them")
+        text = "\n".join(lines)
+        if len(text) > 1900:
+            await ctx.send(
+                file=discord.File(io.BytesIO(text.encode()), filename="metrics.txt")
+            )
+        else:
+            await ctx.send(f"```\n{text}\n```")
+
 
 def setup(bot: Bot) -> None:
     bot.add_cog(AdminCog(bot))
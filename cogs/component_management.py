@@ -45,9 +45,8 @@ class ComponentChecking(Cog):
 
     @tasks.loop(minutes=120)
     async def check_components(self) -> None:
-        logger.debug(f"Checking component listeners: {self.bot.component_listeners}")
         await self.bot.clean_component_listeners()
-        logger.debug(f"Finished checking: {self.bot.component_listeners}")
+        logger.debug(f"Component listeners: {self.bot.component_listeners.metrics()}")
 
 
 def setup(bot: Bot) -> None:
@@ -18,14 +18,17 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import asyncio
 import logging
 
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, List, Optional
+
+import aiohttp
 
 from discord.ext import commands, tasks
 
 from main import Bot
-from src import Context, list_wrappers
+from src import Context, list_wrappers, metrics
 
 if TYPE_CHECKING:
     Cog = commands.Cog[Context]
@@ -39,24 +42,43 @@ logger = logging.getLogger(__name__)
 class ListingCog(Cog):
     def __init__(self, bot: Bot) -> None:
         self.bot = bot
+        # The sites share a session, made in before_stats_post so it's on the bot's loop
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.sites: List[list_wrappers.HttpClient] = []
         self.stats_post_loop.start()
-        self.de_list = list_wrappers.Del(token=self.bot.del_token, bot=self.bot)
-        self.dbl = list_wrappers.Dbl(token=self.bot.dbl_token, bot=self.bot)
-        self.dboats = list_wrappers.DBoats(token=self.bot.dboats_token, bot=self.bot)
-        self.dbgg = list_wrappers.Dbgg(token=self.bot.dbgg_token, bot=self.bot)
-        self.topgg = list_wrappers.TopGG(token=self.bot.topgg_token, bot=self.bot)
 
     def cog_unload(self) -> None:
         self.stats_post_loop.cancel()
+        for site in self.sites:
+            metrics.registry.remove_collector(f"listing_{site.name}")
+        if self.session is not None:
+            self.bot.loop.create_task(self.session.close())
 
     @tasks.loop(minutes=30)
     async def stats_post_loop(self) -> None:
+        guild_count = self.bot.total_guild_count()
+        if guild_count is None:
+            logger.info("Not posting stats, not every cluster has sent its guilds yet")
+            return
+        await asyncio.gather(*(site.post(guild_count) for site in self.sites))
+
+    @stats_post_loop.before_loop
+    async def before_stats_post(self) -> None:
         await self.bot.wait_until_ready()
-        await self.de_list.post_guild_stats()
-        await self.dbl.post_guild_stats()
-        await self.dboats.post_guild_stats()
-        await self.dbgg.post_guild_stats()
-        await self.topgg.post_guild_stats()
+        if self.session is not None and not self.session.closed:
+            return  # The loop was restarted, the sites are already set up
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit_per_host=2, keepalive_timeout=60)
+        )
+        self.sites = [
+            list_wrappers.Del(self.bot, self.bot.del_token, self.session),
+            list_wrappers.Dbl(self.bot, self.bot.dbl_token, self.session),
+            list_wrappers.DBoats(self.bot, self.bot.dboats_token, self.session),
+            list_wrappers.Dbgg(self.bot, self.bot.dbgg_token, self.session),
+            list_wrappers.TopGG(self.bot, self.bot.topgg_token, self.session),
+        ]
+        for site in self.sites:
+            metrics.registry.add_collector(f"listing_{site.name}", site.metrics)
 
 
 def setup(bot: Bot) -> None:
@@ -37,7 +37,6 @@ from src.interactions import (
     InteractionResponseFlags,
     InteractionResponseType,
 )
-from src.models import CommandUsageAnalytics
 
 if TYPE_CHECKING:
     Cog = commands.Cog[Context]
@@ -296,7 +295,7 @@ class MainCog(Cog):
                 if help_command is not None:
                     await ctx.invoke(help_command)
 
-        await success_analytics(ctx)
+        success_analytics(ctx)
 
     async def handle_info_command(self, interaction: CommandInteraction) -> None:
         sub_commands = interaction.data.options
@@ -360,7 +359,7 @@ class MainCog(Cog):
             "source",
             "support",
         ):
-            await CommandUsageAnalytics.create(
+            self.bot.analytics.record(
                 guild_id=interaction.guild_id,
                 command_name=["info", sub_name],
                 slash=True,
@@ -374,38 +373,38 @@ class MainCog(Cog):
             bot=self.bot, guild_id=guild_id, guild_data=ctx.guild_data
         )
         await ctx.send(embed=embed)
-        await success_analytics(ctx)
+        success_analytics(ctx)
 
     @commands.command(name="ping")
     async def ping(self, ctx: Context) -> None:
         await ctx.send(f"Gateway latency: {round(self.bot.latency*1000, 2)}ms")
-        await success_analytics(ctx)
+        success_analytics(ctx)
 
     @commands.command()
     async def privacy(self, ctx: Context) -> None:
         embed = create_privacy_embed()
         await ctx.send(embed=embed)
-        await success_analytics(ctx)
+        success_analytics(ctx)
 
     @commands.command()
     async def invite(self, ctx: Context) -> None:
         await ctx.send(embed=create_invite_embed())
-        await success_analytics(ctx)
+        success_analytics(ctx)
 
     @commands.command()
     async def docs(self, ctx: Context) -> None:
         await ctx.send(embed=create_docs_embed())
-        await success_analytics(ctx)
+        success_analytics(ctx)
 
     @commands.command()
     async def source(self, ctx: Context) -> None:
         await ctx.send(embed=create_source_embed())
-        await success_analytics(ctx)
+        success_analytics(ctx)
 
     @commands.command()
     async def support(self, ctx: Context) -> None:
         await ctx.send(embed=create_support_embed())
-        await success_analytics(ctx)
+        success_analytics(ctx)
 
 
 def setup(bot: Bot) -> None:
@@ -19,9 +19,10 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import asyncio
+import io
 import json
 import logging
-import os
+import time
 
 from datetime import datetime, timezone
 from typing import TYPE_CHECKING, Dict, List, NamedTuple, Optional, TypedDict, Union
@@ -31,8 +32,9 @@ import discord
 from discord.ext import commands
 
 from main import Bot
-from src import Context, checks, errors, send_log_once
+from src import Context, checks, errors, metrics, send_log_once
 from src.analytics import get_success_code, success_analytics
+from src.custom_ids import CustomIdData, encode_custom_id
 from src.interactions import (
     ActionRow,
     Button,
@@ -41,10 +43,11 @@ from src.interactions import (
     InteractionResponseFlags,
     InteractionResponseType,
     PartialEmoji,
+    Select,
     edit_message_components,
     send_message_components,
 )
-from src.models import CommandStatus, CommandUsageAnalytics
+from src.models import CommandStatus
 
 if TYPE_CHECKING:
     Cog = commands.Cog[Context]
@@ -58,6 +61,22 @@ MAX_EMBED_DESCRIPTION_LENGTH = 4096
 
 logger = logging.getLogger(__name__)
 
+CONFIRM_TIMEOUT = 60.0
+
+# Templates for confirm(), each prompt only changes the custom_id
+CONFIRM_BUTTON = Button(
+    style=ButtonStyle.Primary,
+    emoji=PartialEmoji(id=None, name="✅").freeze(),
+    label="Confirm",
+    custom_id="",
+).freeze()
+CANCEL_BUTTON = Button(
+    style=ButtonStyle.Danger,
+    emoji=PartialEmoji(id=None, name="❌").freeze(),
+    label="Cancel",
+    custom_id="",
+).freeze()
+
 
 class ComfirmEmbedTuple(NamedTuple):
     confirmation_embed: discord.Embed
@@ -81,6 +100,14 @@ def check_content_length(
         )
 
 
+def text_file(content: str, filename: str) -> discord.File:
+    return discord.File(io.BytesIO(content.encode()), filename=filename)
+
+
+def json_file(content: Union[dict, list], filename: str) -> discord.File:
+    return discord.File(io.BytesIO(json.dumps(content).encode()), filename=filename)
+
+
 def embed_from_dict(d: dict) -> discord.Embed:
     try:
         e = discord.Embed.from_dict(d)
@@ -105,30 +132,27 @@ async def confirm(
     content_name: str,
     original_content: Optional[str] = None,
 ) -> bool:
-    base_custom_id = f"{author_id}-{initial_message_id}"
-    cancel_custom_id = f"{base_custom_id}-n"
-    confirm_custom_id = f"{base_custom_id}-y"
-    components = [
+    # Signed so any process can tell who the prompt is for and when it expires
+    expires_at = time.time() + CONFIRM_TIMEOUT + 5
+    cancel_custom_id = encode_custom_id(
+        "cancel", author_id, initial_message_id, expires_at
+    )
+    confirm_custom_id = encode_custom_id(
+        "confirm", author_id, initial_message_id, expires_at
+    )
+    buttons: List[Union[Button, Select]] = [
+        CONFIRM_BUTTON.evolve(custom_id=confirm_custom_id),
+        CANCEL_BUTTON.evolve(custom_id=cancel_custom_id),
+    ]
+    components = [ActionRow(components=buttons).freeze()]
+    disabled_components = [
         ActionRow(
-            components=[
-                Button(
-                    style=ButtonStyle.Primary,
-                    emoji=PartialEmoji(id=None, name="✅"),
-                    label="Confirm",
-                    custom_id=confirm_custom_id,
-                ),
-                Button(
-                    style=ButtonStyle.Danger,
-                    emoji=PartialEmoji(id=None, name="❌"),
-                    label="Cancel",
-                    custom_id=cancel_custom_id,
-                ),
-            ]
-        )
+            components=[button.evolve(disabled=True) for button in buttons]
+        ).freeze()
     ]
 
     msg_id = await send_message_components(
-        embed=embed, channel_id=channel_id, components=components, state=bot._connection  # type: ignore
+        embed=embed, channel_id=channel_id, components=components, state=bot._connection, scheduler=bot.http_scheduler  # type: ignore
     )
 
     async def check(interaction: ComponentInteraction) -> bool:
@@ -143,12 +167,11 @@ async def confirm(
             return True
 
     try:
-        button_interaction: ComponentInteraction = await bot.wait_for_components(
-            components=components, check=check, timeout=60.0
-        )
+        with metrics.timer("confirm_wait_seconds"):
+            button_interaction: ComponentInteraction = await bot.wait_for_components(
+                components=components, check=check, timeout=CONFIRM_TIMEOUT
+            )
     except asyncio.TimeoutError:
-        for component in components[0].components:
-            component.disabled = True
         state = "timed out"
         colour = discord.Colour.red()
         if original_content:
@@ -163,7 +186,7 @@ async def confirm(
         finished_embed.colour = colour
         finished_embed.title = finished_embed.title.format(state=state)  # type: ignore
         await edit_message_components(
-            embed=finished_embed, components=components, channel_id=channel_id, message_id=msg_id, state=bot._connection  # type: ignore
+            embed=finished_embed, components=disabled_components, channel_id=channel_id, message_id=msg_id, state=bot._connection, scheduler=bot.http_scheduler  # type: ignore
         )
         return False
     else:
@@ -189,12 +212,10 @@ async def confirm(
             return_value = False
         finished_embed.colour = colour
         finished_embed.title = finished_embed.title.format(state=state)  # type: ignore
-        for component in components[0].components:
-            component.disabled = True
         await button_interaction.respond(
             response_type=InteractionResponseType.UpdateMessage,
             embeds=[finished_embed],
-            components=components,
+            components=disabled_components,
         )
         return return_value
 
@@ -202,6 +223,30 @@ async def confirm(
 class MessagesCog(Cog):
     def __init__(self, bot: Bot) -> None:
         self.bot = bot
+        self.bot.component_handlers.update(
+            {"confirm": self.handle_lost_confirm, "cancel": self.handle_lost_cancel}
+        )
+
+    def cog_unload(self) -> None:
+        self.bot.component_handlers.pop("confirm", None)
+        self.bot.component_handlers.pop("cancel", None)
+
+    async def handle_lost_confirm(
+        self, interaction: ComponentInteraction, data: CustomIdData
+    ) -> None:
+        # The command that was waiting is gone, eg the bot restarted
+        await self.bot.respond_disabled_components(
+            interaction,
+            "❗This prompt was lost when the bot restarted, please run the command again.",
+            disable_all=True,
+        )
+
+    async def handle_lost_cancel(
+        self, interaction: ComponentInteraction, data: CustomIdData
+    ) -> None:
+        await self.bot.respond_disabled_components(
+            interaction, "Cancelled!", disable_all=True
+        )
 
     async def cog_check(self, ctx: Context) -> bool:
         return await checks.check_if_manage_role(self.bot, ctx)
@@ -251,7 +296,7 @@ class MessagesCog(Cog):
             )
 
             success = CommandStatus.UNKNOWN_ERROR
-        await CommandUsageAnalytics.create(
+        self.bot.analytics.record(
             guild_id=ctx.guild.id if ctx.guild is not None else None,
             command_name=[*ctx.invoked_parents, ctx.invoked_with],
             slash=False,
@@ -408,19 +453,13 @@ class MessagesCog(Cog):
                 inline=list_content[key]["inline"],
             )
         if len(content) >= 500 or len(message.content) >= 500:
-            with open("content.txt", "w+") as f:
-                if command_type == "edit":
-                    f.write(
-                        f"Original Content:\n\n{message.content}\n\nNew Content:\n\n{content}"
-                    )
-                    del list_content["content"]
-                    del list_content["original_content"]
-                elif command_type == "fetch":
-                    f.write(f"Content:\n\n{content}")
-                    del list_content["content"]
-                else:
-                    f.write(f"Content:\n\n{content}")
-                    del list_content["content"]
+            if command_type == "edit":
+                file_content = f"Original Content:\n\n{message.content}\n\nNew Content:\n\n{content}"
+                del list_content["content"]
+                del list_content["original_content"]
+            else:
+                file_content = f"Content:\n\n{content}"
+                del list_content["content"]
             embed = discord.Embed(
                 title=f"{title} the message!",
                 colour=discord.Colour(0xC387C1),
@@ -437,9 +476,8 @@ class MessagesCog(Cog):
                 bot=self.bot,
                 logger_type="main",
                 embeds=[embed],
-                file=discord.File("content.txt", filename="content.txt"),
+                file=text_file(file_content, "content.txt"),
             )
-            os.remove("content.txt")
         else:
             await send_log_once(
                 guild_id=ctx.guild.id, bot=self.bot, logger_type="main", embeds=[embed]
@@ -548,7 +586,7 @@ class MessagesCog(Cog):
             await self.send_message_info_embed(
                 ctx, "Send", ctx.author, content, msg, channel
             )
-        await success_analytics(ctx, not success)
+        success_analytics(ctx, not success)
 
     # Create the edit command. This command will edit the specificed message. (Message must be from the bot)
     @commands.command(name="edit")
@@ -602,7 +640,7 @@ class MessagesCog(Cog):
             )
             await msg.edit(content=content)
 
-        await success_analytics(ctx, not success)
+        success_analytics(ctx, not success)
 
     # Create the command delete. This will delete a message from the bot.
     @commands.command(name="delete", aliases=["delete-embed"])
@@ -670,24 +708,20 @@ class MessagesCog(Cog):
                 )
                 log_embed.add_field(name="Deleter", value=ctx.author.mention)
                 log_embed.add_field(name="Channel", value=channel.mention)
-                file_name = f"{ctx.author.id}-{datetime.utcnow()}-content.json"
-                with open(file_name, "w+") as f:
-                    embeds_list = []
-                    for embed in msg.embeds:
-                        embeds_list.append(embed.to_dict())
-                    message_content_dict = {"embeds": embeds_list, "content": ""}
-                    if msg.content is not None:
-                        message_content_dict["content"] = msg.content
-
-                    json.dump(message_content_dict, f)
+                embeds_list = []
+                for embed in msg.embeds:
+                    embeds_list.append(embed.to_dict())
+                message_content_dict = {"embeds": embeds_list, "content": ""}
+                if msg.content is not None:
+                    message_content_dict["content"] = msg.content
+
                 await send_log_once(
                     guild_id=ctx.guild.id,
                     bot=self.bot,
                     logger_type="main",
                     embeds=[log_embed],
-                    file=discord.File(file_name, filename="content.json"),
+                    file=json_file(message_content_dict, "content.json"),
                 )
-                os.remove(file_name)
 
             else:
                 await self.send_message_info_embed(
@@ -698,7 +732,7 @@ class MessagesCog(Cog):
             except discord.errors.Forbidden:
                 raise errors.ContentError("There was an unknown error!")
 
-        await success_analytics(ctx, not success)
+        success_analytics(ctx, not success)
 
     @commands.command(name="fetch", aliases=["fetch-embed"])
     async def fetch(
@@ -714,32 +748,22 @@ class MessagesCog(Cog):
             )
 
         msg = await self.check_message_id(ctx, channel, message_id)
-        file_name = f"{ctx.author.id}-{datetime.utcnow()}-content"
         if len(msg.embeds) == 0:
-            file_name = file_name + ".txt"
-            with open(file_name, "w+") as f:
-                f.write(f"Content:\n\n{msg.content}")
-        else:
-            file_name = file_name + ".json"
-            with open(file_name, "w+") as f:
-                embeds_list = []
-                for embed in msg.embeds:
-                    embeds_list.append(embed.to_dict())
-                message_content_dict = {"embeds": embeds_list, "content": ""}
-                if msg.content is not None:
-                    message_content_dict["content"] = msg.content
-
-                json.dump(message_content_dict, f)
-        if file_name[-4:] == "json":
-            file_display_name = "content.json"
+            file = text_file(f"Content:\n\n{msg.content}", "content.txt")
         else:
-            file_display_name = "content.txt"
+            embeds_list = []
+            for embed in msg.embeds:
+                embeds_list.append(embed.to_dict())
+            message_content_dict = {"embeds": embeds_list, "content": ""}
+            if msg.content is not None:
+                message_content_dict["content"] = msg.content
+
+            file = json_file(message_content_dict, "content.json")
         await ctx.send(
             content="Fetched the message! Contents in the attached text file.",
-            file=discord.File(file_name, filename=file_display_name),
+            file=file,
         )
-        os.remove(file_name)
-        await success_analytics(ctx)
+        success_analytics(ctx)
 
     @commands.command(name="send-embed")
     async def send_embed(
@@ -798,20 +822,14 @@ class MessagesCog(Cog):
                     timestamp=datetime.now(timezone.utc),
                 )
                 log_embed.add_field(name="Title", value=title)
-                file_name = f"{ctx.author.id}-{datetime.utcnow()}-content.json"
-                with open(file_name, "w+") as f:
-                    message_content_dict = embed.to_dict()
-
-                    json.dump(message_content_dict, f)
                 await send_log_once(
                     guild_id=ctx.guild.id,
                     bot=self.bot,
                     logger_type="main",
                     embeds=[log_embed],
-                    file=discord.File(file_name, filename="content.json"),
+                    file=json_file(embed.to_dict(), "content.json"),
                 )
-                os.remove(file_name)
-            await success_analytics(ctx, not success)
+            success_analytics(ctx, not success)
 
     @commands.command(name="send-embed-json")
     async def send_json_embed(
@@ -925,10 +943,6 @@ class MessagesCog(Cog):
             content_name="Embed Title",
         )
         if success:
-            file_name = f"{ctx.author.id}-{datetime.utcnow()}-content.json"
-            with open(file_name, "w+") as f:
-                json.dump(dict_content, f)
-
             if content_to_send is not None:
                 await channel.send(content_to_send)
             for embed in final_embeds:
@@ -938,11 +952,10 @@ class MessagesCog(Cog):
                 bot=self.bot,
                 logger_type="main",
                 embeds=[log_embed],
-                file=discord.File(file_name, filename="content.json"),
+                file=json_file(dict_content, "content.json"),
             )
-            os.remove(file_name)
 
-        await success_analytics(ctx, not success)
+        success_analytics(ctx, not success)
 
     @commands.command(name="edit-embed")
     async def edit_embed(
@@ -1019,28 +1032,19 @@ class MessagesCog(Cog):
             )
             log_embed.add_field(name="Editor", value=ctx.author.mention)
             log_embed.add_field(name="Channel", value=channel.mention)
-            old_file_name = f"{ctx.author.id}-{datetime.utcnow()}-old-content.json"
-            with open(old_file_name, "w+") as f:
-                json.dump(old_embed, f)
-
-            new_file_name = f"{ctx.author.id}-{datetime.utcnow()}-new-content.json"
-            with open(new_file_name, "w+") as f:
-                json.dump(new_embed.to_dict(), f)
             await send_log_once(
                 guild_id=ctx.guild.id,
                 bot=self.bot,
                 logger_type="main",
                 embeds=[log_embed],
                 files=[
-                    discord.File(new_file_name, filename="new-content.json"),
-                    discord.File(old_file_name, "old-content.json"),
+                    json_file(new_embed.to_dict(), "new-content.json"),
+                    json_file(old_embed, "old-content.json"),
                 ],
             )
-            os.remove(new_file_name)
-            os.remove(old_file_name)
             await msg.edit(embed=new_embed)
 
-        await success_analytics(ctx, not success)
+        success_analytics(ctx, not success)
 
     @commands.command(name="edit-embed-json")
     async def json_edit(
@@ -1149,27 +1153,18 @@ class MessagesCog(Cog):
         )
         if success:
             await msg.edit(embed=final_embed)
-            old_file_name = f"{ctx.author.id}-{datetime.utcnow()}-old-content.json"
-            with open(old_file_name, "w+") as f:
-                json.dump(old_embed, f)
-
-            new_file_name = f"{ctx.author.id}-{datetime.utcnow()}-new-content.json"
-            with open(new_file_name, "w+") as f:
-                json.dump(new_dict_content, f)
             await send_log_once(
                 guild_id=ctx.guild.id,
                 bot=self.bot,
                 logger_type="main",
                 embeds=[log_embed],
                 files=[
-                    discord.File(new_file_name, filename="new-content.json"),
-                    discord.File(old_file_name, "old-content.json"),
+                    json_file(new_dict_content, "new-content.json"),
+                    json_file(old_embed, "old-content.json"),
                 ],
             )
-            os.remove(new_file_name)
-            os.remove(old_file_name)
 
-        await success_analytics(ctx, not success)
+        success_analytics(ctx, not success)
 
 
 def setup(bot: Bot) -> None:
@@ -21,7 +21,7 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import logging
 
 from datetime import datetime, timezone
-from typing import TYPE_CHECKING, Awaitable, Optional, Union
+from typing import TYPE_CHECKING, Optional, Union
 
 import discord
 
@@ -40,7 +40,7 @@ from src.interactions import (
     PartialChannel,
     PartialRole,
 )
-from src.models import Channel, CommandStatus, CommandUsageAnalytics, LoggingChannel
+from src.models import Channel, CommandStatus, LoggingChannel
 
 if TYPE_CHECKING:
     Cog = commands.Cog[Context]
@@ -125,6 +125,10 @@ class LogicFunctions:
                 embed.description = "Logging channel not updated! It remains None"
             else:
                 await logging_channel.delete()
+                await self.bot.invalidation.publish(
+                    "logging_channel", (guild.id, "main")
+                )
+                self.bot.server_loggers.pop(logging_channel.channel_id, None)
                 embed.description = f"Logging channel updated from <#{logging_channel.channel_id}> to None"
             return embed
         else:
@@ -157,6 +161,9 @@ class LogicFunctions:
                 original_channel = logging_channel.channel_id
                 logging_channel.channel = db_channel[0]
             await logging_channel.save()
+            await self.bot.invalidation.publish("logging_channel", (guild.id, "main"))
+            if original_channel is not None:
+                self.bot.server_loggers.pop(original_channel, None)
 
             if original_channel is None:
                 embed.description = f"Logging channel updated to {channel.mention}"
@@ -256,7 +263,7 @@ class SetupCog(Cog):
             await ctx.send(error)
             success = get_success_code(error)
 
-            await CommandUsageAnalytics.create(
+            self.bot.analytics.record(
                 guild_id=ctx.guild.id if ctx.guild is not None else None,
                 command_name=[*ctx.invoked_parents, ctx.invoked_with],
                 slash=False,
@@ -272,15 +279,15 @@ class SetupCog(Cog):
             logger.error(
                 f"Ignoring exception in interaction {ctx.command}:", exc_info=error
             )
-            await CommandUsageAnalytics.create(
+            self.bot.analytics.record(
                 guild_id=ctx.guild.id if ctx.guild is not None else None,
                 command_name=[*ctx.invoked_parents, ctx.invoked_with],
                 slash=False,
                 success=CommandStatus.UNKNOWN_ERROR,
             )
 
-    def success_analytics(self, ctx: Context) -> Awaitable:
-        return CommandUsageAnalytics.create(
+    def success_analytics(self, ctx: Context) -> None:
+        self.bot.analytics.record(
             guild_id=ctx.guild.id if ctx.guild is not None else None,
             command_name=[*ctx.invoked_parents, ctx.invoked_with],
             slash=False,
@@ -313,7 +320,7 @@ class SetupCog(Cog):
                 inline=False,
             )
             await ctx.send(embed=embed)
-            await self.success_analytics(ctx)
+            self.success_analytics(ctx)
 
     @setup.command(name="prefix")
     async def return_prefix(
@@ -332,7 +339,7 @@ class SetupCog(Cog):
                 ctx.guild, new_prefix
             )
             await ctx.send(embed=msg_embed)
-        await self.success_analytics(ctx)
+        self.success_analytics(ctx)
 
     @commands.has_guild_permissions(administrator=True)
     @setup.command()
@@ -352,7 +359,7 @@ class SetupCog(Cog):
             await ctx.send(embed=msg)
         else:
             await ctx.send(content=msg)
-        await self.success_analytics(ctx)
+        self.success_analytics(ctx)
 
     @setup.command(name="logging")
     async def set_logging(
@@ -371,7 +378,7 @@ class SetupCog(Cog):
             await ctx.send(embed=msg)
         else:
             await ctx.send(msg)
-        await self.success_analytics(ctx)
+        self.success_analytics(ctx)
 
     @commands.command(name="prefix")
     async def prefix(self, ctx: Context) -> None:
@@ -380,7 +387,7 @@ class SetupCog(Cog):
             await ctx.send(f"My prefix for this server is: `{guild.prefix}`")
         else:
             await ctx.send(f"My prefix is `{self.bot.default_prefix}`")
-        await self.success_analytics(ctx)
+        self.success_analytics(ctx)
 
 
 class SetupCogSlash(Cog):
@@ -460,7 +467,7 @@ class SetupCogSlash(Cog):
                     success = CommandStatus.MISSING_BOT_SCOPE
                 else:
                     success = CommandStatus.GUILD_ONLY_COMMAND_IN_DM
-                await CommandUsageAnalytics.create(
+                self.bot.analytics.record(
                     guild_id=interaction.guild_id,
                     command_name=["setup", sub_group_name, sub_command_name],
                     slash=True,
@@ -479,7 +486,7 @@ class SetupCogSlash(Cog):
                     content="You do not have the required permissions to run this command: `ADMINISTRATOR`",
                     flags=InteractionResponseFlags.EPHEMERAL,
                 )
-                await CommandUsageAnalytics.create(
+                self.bot.analytics.record(
                     guild_id=interaction.guild_id,
                     command_name=["setup", sub_group_name, sub_command_name],
                     slash=True,
@@ -555,14 +562,14 @@ class SetupCogSlash(Cog):
                 if isinstance(e, errors.InputContentIncorrect)
                 else CommandStatus.CHANNEL_INPUT_NOT_TEXT_CHANNEL
             )
-            await CommandUsageAnalytics.create(
+            self.bot.analytics.record(
                 guild_id=interaction.guild_id,
                 command_name=["setup", sub_group_name, sub_command_name],
                 slash=True,
                 success=success,
             )
             return
-        await CommandUsageAnalytics.create(
+        self.bot.analytics.record(
             guild_id=interaction.guild_id,
             command_name=["setup", sub_group_name, sub_command_name],
             slash=True,
@@ -19,7 +19,9 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import asyncio
 import datetime
+import functools
 import logging
+import time
 
 from asyncio.futures import Future
 from typing import (
@@ -28,6 +30,7 @@ from typing import (
     Awaitable,
     Callable,
     Dict,
+    Hashable,
     List,
     Optional,
     Sequence,
@@ -44,32 +47,49 @@ from tortoise import Tortoise
 
 import load_config
 
-from src import Context, PartialGuildCache
+from src import Context, LoggingChannelCache, PartialGuildCache, metrics
+from src.analytics import AnalyticsQueue
+from src.cluster import HEARTBEAT_INTERVAL, Heartbeat, run_cluster, shard_id_for_guild
+from src.component_listeners import ComponentListeners
+from src.custom_ids import CustomIdData, decode_custom_id
+from src.db import InstrumentedAsyncpgDBClient
 from src.errors import NoComponents
+from src.http_scheduler import AiohttpBackend, HTTPScheduler
 from src.interactions import (
     ActionRow,
     Button,
     CommandInteraction,
     ComponentInteraction,
-    Interaction,
     InteractionResponseFlags,
     InteractionResponseType,
-    InteractionType,
     Select,
+    interaction_factory,
 )
+from src.invalidation import InvalidationBus, create_invalidation_bus
 from tortoise_config import TORTOISE_ORM
 
 __version__ = "v3.1.0"
 
 if TYPE_CHECKING:
-    BotBase = commands.Bot[Context]
+    import ctypes
+    import multiprocessing
+
+    from src.hooks_and_logging import ServerLogger
+
+    BotBase = commands.AutoShardedBot[Context]
 else:
-    BotBase = commands.Bot
+    BotBase = commands.AutoShardedBot
 
 
 class Bot(BotBase):
     def __init__(
-        self, default_prefix: str, self_hosted: bool = False, **kwargs: Any
+        self,
+        default_prefix: str,
+        self_hosted: bool = False,
+        cluster_id: Optional[int] = None,
+        heartbeats: Optional["multiprocessing.Queue[Heartbeat]"] = None,
+        guild_count: Optional["ctypes.c_longlong"] = None,
+        **kwargs: Any,
     ) -> None:
 
         super().__init__(  # type: ignore
@@ -82,10 +102,24 @@ class Bot(BotBase):
         )
         self.default_prefix = default_prefix
         self.self_hosted = self_hosted
+        self.cluster_id = cluster_id  # None when not run by the cluster supervisor
+        self.heartbeats = heartbeats
+        self.cluster_guild_count = guild_count  # Every cluster's guilds, 0 until known
         self.start_time = datetime.datetime.utcnow()
         self.session: aiohttp.ClientSession
+        self.http_scheduler: HTTPScheduler
         self.version = __version__
         self.guild_cache: PartialGuildCache
+        self.guild_cache_warmed = False
+        self.logger_cache: LoggingChannelCache
+        self.invalidation: InvalidationBus
+        self.server_loggers: Dict[int, ServerLogger] = {}  # {channel_id: logger}
+        self.avatar_bytes: Optional[bytes] = None
+        self.analytics: AnalyticsQueue
+        self.messages_rejected = 0  # Not commands, rejected before get_context
+        self.messages_accepted = 0
+        self.interactions_deferred = 0  # Slash commands that took too long to respond
+        self.metrics_server: Optional[metrics.MetricsServer] = None
         self.load_time: datetime.datetime
         self.dbl_token: str
         self.dboats_token: str
@@ -93,29 +127,166 @@ class Bot(BotBase):
         self.dbgg_token: str
         self.topgg_token: str
         self.slash_commands: Dict[str, Callable] = {}
-        self.component_listeners: Dict[
-            str, Tuple[Future[Any], Callable[[ComponentInteraction], Awaitable[bool]]]
+        self.component_listeners = ComponentListeners()
+        # {action: handler} for signed custom ids that have no listener
+        self.component_handlers: Dict[
+            str, Callable[[ComponentInteraction, CustomIdData], Awaitable[None]]
         ] = {}
-        self.removed_listeners: List[str] = []
         self.inject_parsers()
 
-    async def init_db(self) -> None:
-        await Tortoise.init(config=TORTOISE_ORM)
+    async def init_db(self, tortoise_config: Dict[str, Any] = TORTOISE_ORM) -> None:
+        await Tortoise.init(config=tortoise_config)
+        self.invalidation = create_invalidation_bus(
+            load_config.cache_invalidation_backend, load_config.uri
+        )
+        await self.invalidation.start()
         self.guild_cache = PartialGuildCache(
             capacity=load_config.guild_cache_max,
             drop_amount=load_config.guild_cache_drop,
+            batch_window=load_config.guild_cache_batch_window,
+            invalidation=self.invalidation,
+        )
+        self.logger_cache = LoggingChannelCache(
+            capacity=load_config.logger_cache_max,
+            drop_amount=load_config.logger_cache_drop,
+            ttl=load_config.logger_cache_ttl,
+        )
+        self.invalidation.subscribe(
+            "logging_channel", self.logger_cache.remove, self.logger_cache.clear
+        )
+        self.invalidation.subscribe("logging_channel", self.forget_server_loggers)
+        self.analytics = AnalyticsQueue(
+            max_size=load_config.analytics_queue_max,
+            batch_size=load_config.analytics_batch_size,
+            flush_interval=load_config.analytics_flush_interval,
+        )
+        self.analytics.start()
+        self.add_metrics_collectors()
+
+    def forget_server_loggers(self, key: Hashable) -> None:
+        # Their webhook may have been replaced, the next log makes them again
+        assert isinstance(key, tuple)
+        guild_id = key[0]
+        for channel_id, server_logger in list(self.server_loggers.items()):
+            if server_logger.guild_id == guild_id:
+                del self.server_loggers[channel_id]
+
+    def add_metrics_collectors(self) -> None:
+        # Read when the metrics are shown, so keeping them costs nothing
+        metrics.registry.add_collector(
+            "bot",
+            lambda: {
+                "guilds": len(self.guilds),
+                "latency": self.latency,
+                "messages_rejected": self.messages_rejected,
+                "messages_accepted": self.messages_accepted,
+                "interactions_deferred": self.interactions_deferred,
+            },
+        )
+        metrics.registry.add_collector("guild_cache", self.guild_cache.metrics)
+        metrics.registry.add_collector("logger_cache", self.logger_cache.metrics)
+        metrics.registry.add_collector("analytics", self.analytics.metrics)
+        metrics.registry.add_collector("invalidation", self.invalidation.metrics)
+        metrics.registry.add_collector(
+            "component_listeners", self.component_listeners.metrics
         )
+        metrics.registry.add_collector("http", self.http_scheduler.metrics)
+        connection = Tortoise.get_connection("default")
+        if isinstance(connection, InstrumentedAsyncpgDBClient):
+            metrics.registry.add_collector("db_pool", connection.metrics)
 
     async def start(self, *args, **kwargs) -> None:  # type: ignore
         self.session = aiohttp.ClientSession()
+        self.http_scheduler = HTTPScheduler(
+            AiohttpBackend(self.session),
+            token=load_config.token,
+            global_limit=load_config.http_global_rate_limit,
+        )
 
         await self.init_db()
+        if load_config.metrics_port > 0:
+            self.metrics_server = metrics.MetricsServer(
+                metrics.registry, load_config.metrics_port + (self.cluster_id or 0)
+            )
+            await self.metrics_server.start()
+        if self.heartbeats is not None:
+            self.loop.create_task(self.send_heartbeats())
         await super().start(*args, **kwargs)
 
     async def close(self) -> None:
+        for server_logger in self.server_loggers.values():
+            try:
+                await server_logger.flush()
+            except Exception:
+                logger.error("Failed to flush logs on close", exc_info=True)
+        # Neither exists if init_db failed, close is still called then
+        analytics: Optional[AnalyticsQueue] = getattr(self, "analytics", None)
+        if analytics is not None:
+            await analytics.close()
+        invalidation: Optional[InvalidationBus] = getattr(self, "invalidation", None)
+        if invalidation is not None:
+            await invalidation.close()
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
         await Tortoise.close_connections()
         await super().close()
 
+    async def on_ready(self) -> None:
+        if load_config.guild_cache_warmup and not self.guild_cache_warmed:
+            self.guild_cache_warmed = True  # on_ready can be called more than once
+            self.loop.create_task(self.warm_guild_cache())
+
+    async def send_heartbeats(self) -> None:
+        assert self.heartbeats is not None and self.cluster_id is not None
+        while not self.is_closed():
+            self.heartbeats.put_nowait(
+                Heartbeat(
+                    cluster_id=self.cluster_id,
+                    sent_at=time.time(),
+                    guilds=len(self.guilds),
+                    latency=self.latency,
+                    ready=self.is_ready(),
+                )
+            )
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    def total_guild_count(self) -> Optional[int]:
+        # For the whole bot, None until every cluster has sent its count
+        if self.cluster_guild_count is None:
+            return len(self.guilds)
+        return self.cluster_guild_count.value or None
+
+    def check_guild_shard(self, guild: discord.Guild) -> None:
+        # Each cluster's caches rely on only getting the guilds of its own shards
+        if self.shard_ids is None:
+            return
+        shard_id = shard_id_for_guild(guild.id, self.shard_count)
+        if shard_id not in self.shard_ids:
+            logger.error(
+                f"Guild {guild.id} belongs to shard {shard_id}, which isn't one of "
+                f"cluster {self.cluster_id}'s shards {self.shard_ids}"
+            )
+
+    async def on_guild_join(self, guild: discord.Guild) -> None:
+        self.check_guild_shard(guild)
+
+    async def on_guild_available(self, guild: discord.Guild) -> None:
+        self.check_guild_shard(guild)
+
+    async def warm_guild_cache(self) -> None:
+        try:
+            loaded = await self.guild_cache.warm(guild.id for guild in self.guilds)
+        except Exception:
+            logger.error("Failed to warm the guild cache", exc_info=True)
+        else:
+            logger.info(f"Warmed the guild cache with {loaded} guilds")
+
+    async def get_avatar_bytes(self) -> bytes:
+        # Only downloaded once per process
+        if self.avatar_bytes is None:
+            self.avatar_bytes = await self.user.avatar_url_as().read()
+        return self.avatar_bytes
+
     def command_with_prefix(self, ctx: Context, command_name: str) -> str:
         if str(self.user.id) in ctx.prefix:
             if isinstance(ctx.me, discord.Member):
@@ -128,6 +299,10 @@ class Bot(BotBase):
     async def process_commands(self, message: discord.Message) -> None:
         if message.author.bot:
             return
+        if not await self.could_be_command(message):
+            self.messages_rejected += 1
+            return
+        self.messages_accepted += 1
         ctx = await self.get_context(message, cls=Context)
         if ctx.command is None:
             return
@@ -135,19 +310,61 @@ class Bot(BotBase):
             await ctx.fetch_guild_data()
         await self.invoke(ctx)
 
+    async def could_be_command(self, message: discord.Message) -> bool:
+        # Checks the raw content against the prefixes before a Context is built,
+        # most messages in large guilds aren't commands
+        if message.guild is None:
+            return True  # No prefix is needed in DMs
+        guild = self.guild_cache.get_nowait(message.guild.id)
+        if guild is None:
+            # get_context then finds the guild in the cache
+            guild = await self.guild_cache.get(message.guild.id)
+        content: str = message.content
+        return content.startswith(guild_prefixes(self.user.id, guild.prefix))
+
     async def on_command_interaction(self, interaction: CommandInteraction) -> None:
         call = self.slash_commands[interaction.data.name]
+        defer_handle = None
+        defer_tasks: List["asyncio.Task[None]"] = []
+        if load_config.interaction_defer_after > 0:
+            # Discord needs a response within 3 seconds, defer if the handler is slow
+            defer_handle = self.loop.call_later(
+                load_config.interaction_defer_after,
+                lambda: defer_tasks.append(
+                    self.loop.create_task(self.defer_interaction(interaction))
+                ),
+            )
+        error = None
         try:
-            await call(interaction)
+            with metrics.timer("slash_command_seconds", command=interaction.data.name):
+                await call(interaction)
         except Exception as e:
-            self.dispatch("slash_command_error", interaction, e)
+            error = e
+        finally:
+            # Stopped before the error is handled, so it doesn't defer after it
+            if defer_handle is not None:
+                defer_handle.cancel()
+            for task in defer_tasks:
+                task.cancel()
+        if error is not None:
+            self.dispatch("slash_command_error", interaction, error)
+
+    async def defer_interaction(self, interaction: CommandInteraction) -> None:
+        try:
+            if await interaction.defer():
+                self.interactions_deferred += 1
+        except discord.HTTPException:
+            logger.warning(
+                f"Failed to defer interaction {interaction.data.name}", exc_info=True
+            )
 
     async def on_slash_command_error(
         self, interaction: CommandInteraction, error: Exception
     ) -> None:
         name = interaction.data.name
         logger.error(f"Ignoring exception in interaction {name}:", exc_info=error)
-        if not interaction.responded:
+        if not interaction.responded or interaction.deferred:
+            # When deferred this replaces the loading message
             await interaction.respond(
                 content=(
                     "There was an unknown error!\n"
@@ -168,12 +385,10 @@ class Bot(BotBase):
             )
 
     def parse_interaction_create(self, data: Dict[Any, Any]) -> None:
-        interaction = Interaction(data=data, state=self._connection)  # type: ignore
-        if data["type"] == InteractionType.APPLICATION_COMMAND:
-            interaction = CommandInteraction(data=data, state=self._connection)  # type: ignore
+        interaction = interaction_factory(data=data, state=self._connection, scheduler=self.http_scheduler)  # type: ignore
+        if isinstance(interaction, CommandInteraction):
             self.dispatch("command_interaction", interaction)
-        elif data["type"] == InteractionType.MESSAGE_COMPONENT:
-            interaction = ComponentInteraction(data=data, state=self._connection)  # type: ignore
+        elif isinstance(interaction, ComponentInteraction):
             self.dispatch("component_interaction", interaction)
             self.dispatch("check_component_interaction", interaction)
 
@@ -231,8 +446,12 @@ class Bot(BotBase):
                 return True
 
             check = _check
-        for component in cleaned_components:
-            self.component_listeners[component.custom_id] = (future, check)
+        self.component_listeners.add(
+            tuple(component.custom_id for component in cleaned_components),
+            future,
+            check,
+            timeout,
+        )
 
         if len(self.component_listeners) > 1000:
             logger.warning("Bot.component_listeners exceeded 1000")
@@ -241,18 +460,35 @@ class Bot(BotBase):
 
     async def dispatch_components(self, interaction: ComponentInteraction) -> None:
         custom_id = interaction.component.custom_id
-        listener = self.component_listeners.get(custom_id, None)
+        # Signed custom ids can be checked without knowing about the prompt
+        decoded = decode_custom_id(custom_id)
+        if decoded is not None:
+            if decoded.expired:
+                await self.respond_disabled_components(
+                    interaction,
+                    "❗This prompt has expired, please run the command again.",
+                    disable_all=True,
+                )
+                return
+            if interaction.author.id != decoded.author_id:
+                await interaction.respond(
+                    response_type=InteractionResponseType.ChannelMessageWithSource,
+                    content="❗Only the user who ran that command can use these buttons!",
+                    flags=InteractionResponseFlags.EPHEMERAL,
+                )
+                return
+        listener = self.component_listeners.get(custom_id)
         no_response = False
         if listener is not None:
             future, condition = listener
             if future.done():
-                self.component_listeners.pop(custom_id)
+                self.component_listeners.remove(custom_id)
                 no_response = True
             else:
                 result = await condition(interaction)
-                if result:
+                if result and not future.done():
                     future.set_result(interaction)
-                    self.component_listeners.pop(custom_id)
+                    self.component_listeners.remove(custom_id)
                 else:
                     no_response = True
 
@@ -261,49 +497,60 @@ class Bot(BotBase):
         if no_response:
             if interaction.responded:
                 return
-            if interaction.message.components is None:
-                # ephemeral message
-                await interaction.respond(
-                    response_type=InteractionResponseType.ChannelMessageWithSource,
-                    content="❗That component could not be found!\n This could be due to an outage, please try the original action again.",
-                    flags=InteractionResponseFlags.EPHEMERAL,
-                )
-            else:
-                components = interaction.message.components
-                for component in components:
-                    if isinstance(component, ActionRow):
-                        for next_component in component.components:
-                            if isinstance(next_component, (Select, Button)):
-                                if (
-                                    next_component.custom_id
-                                    == interaction.component.custom_id
-                                ):
-                                    next_component.disabled = True
-                    if isinstance(component, (Select, Button)):
-                        if component.custom_id == interaction.component.custom_id:
-                            component.disabled = True
-                await interaction.respond(
-                    content=interaction.message.content,
-                    embeds=interaction.message.embeds,
-                    response_type=InteractionResponseType.UpdateMessage,
-                    components=components,
-                )
-                await interaction.create_followup(
-                    content="❗That component could not be found!\n This could be due to an outage, please try the original action again.",
-                    flags=InteractionResponseFlags.EPHEMERAL,
-                )
+            if decoded is not None:
+                # No listener in this process, eg after a restart or on another cluster
+                handler = self.component_handlers.get(decoded.action)
+                if handler is not None:
+                    await handler(interaction, decoded)
+                    return
+            await self.respond_disabled_components(
+                interaction,
+                "❗That component could not be found!\n This could be due to an outage, please try the original action again.",
+            )
 
-    async def check_component_listener(self, custom_id: str) -> None:
-        future, check = self.component_listeners[custom_id]
-        if future.done():
-            self.removed_listeners.append(custom_id)
+    async def respond_disabled_components(
+        self, interaction: ComponentInteraction, content: str, disable_all: bool = False
+    ) -> None:
+        # Disables the used component (or all of them) and tells the user why
+        if interaction.message.components is None:
+            # ephemeral message
+            await interaction.respond(
+                response_type=InteractionResponseType.ChannelMessageWithSource,
+                content=content,
+                flags=InteractionResponseFlags.EPHEMERAL,
+            )
+            return
+        components = interaction.message.components
+        for component in components:
+            if isinstance(component, ActionRow):
+                for next_component in component.components:
+                    if isinstance(next_component, (Select, Button)):
+                        if (
+                            disable_all
+                            or next_component.custom_id
+                            == interaction.component.custom_id
+                        ):
+                            next_component.disabled = True
+            if isinstance(component, (Select, Button)):
+                if (
+                    disable_all
+                    or component.custom_id == interaction.component.custom_id
+                ):
+                    component.disabled = True
+        await interaction.respond(
+            content=interaction.message.content,
+            embeds=interaction.message.embeds,
+            response_type=InteractionResponseType.UpdateMessage,
+            components=components,
+        )
+        await interaction.create_followup(
+            content=content,
+            flags=InteractionResponseFlags.EPHEMERAL,
+        )
 
     async def clean_component_listeners(self) -> None:
-        for listener in self.component_listeners:
-            await self.check_component_listener(listener)
-        for custom_id in self.removed_listeners:
-            self.component_listeners.pop(custom_id)
-        self.removed_listeners = []
+        # Listeners remove themselves, this only trims the deadline heap
+        self.component_listeners.compact()
 
     async def on_error(self, event_method: str, *args: Any, **kwargs: Any) -> None:
         logger.error(f"Ignoring exception in {event_method}", exc_info=True)
@@ -337,25 +584,53 @@ if load_config.sentry_dsn:
     )
 
 
-async def get_custom_prefix(bot: Bot, message: discord.Message) -> List[str]:
-
-    if message.guild is not None:
-        guild = await bot.guild_cache.get(
-            message.guild.id
-        )  # Fetch current server prefix from database
-        prefix = [guild.prefix]
-    else:
-        prefix = [load_config.default_prefix, ""]
-
-    return commands.when_mentioned_or(*prefix)(bot, message)
-
-
-def run() -> None:
+@functools.lru_cache(maxsize=1024)
+def guild_prefixes(user_id: int, prefix: str) -> Tuple[str, ...]:
+    # The same prefixes as commands.when_mentioned_or(prefix), usable with str.startswith
+    return (f"<@{user_id}> ", f"<@!{user_id}> ", prefix)
+
+
+async def fetch_custom_prefix(bot: Bot, guild_id: int) -> List[str]:
+    with metrics.timer("prefix_seconds", source="database"):
+        guild = await bot.guild_cache.get(guild_id)  # Fetch server prefix from database
+        return list(guild_prefixes(bot.user.id, guild.prefix))
+
+
+def get_custom_prefix(
+    bot: Bot, message: discord.Message
+) -> Union[List[str], Awaitable[List[str]]]:
+    # discord.py awaits the result only if it is a coroutine, so cache hits stay sync
+    if message.guild is None:
+        dm_prefixes: List[str] = commands.when_mentioned_or(
+            load_config.default_prefix, ""
+        )(bot, message)
+        return dm_prefixes
+    start = time.perf_counter()
+    guild = bot.guild_cache.get_nowait(message.guild.id)
+    if guild is None:
+        return fetch_custom_prefix(bot, message.guild.id)
+    prefixes = list(guild_prefixes(bot.user.id, guild.prefix))
+    metrics.observe("prefix_seconds", time.perf_counter() - start, source="cache")
+    return prefixes
+
+
+def run_bot(
+    cluster_id: Optional[int] = None,
+    shard_ids: Optional[List[int]] = None,
+    shard_count: Optional[int] = None,
+    heartbeats: Optional["multiprocessing.Queue[Heartbeat]"] = None,
+    guild_count: Optional["ctypes.c_longlong"] = None,
+) -> None:
     bot = Bot(
         owner_ids=load_config.owners,
         default_prefix=load_config.default_prefix,
         self_hosted=load_config.self_host,
         command_prefix=get_custom_prefix,
+        cluster_id=cluster_id,
+        heartbeats=heartbeats,
+        guild_count=guild_count,
+        shard_ids=shard_ids,
+        shard_count=shard_count,
     )
 
     extensions = [
@@ -373,12 +648,27 @@ def run() -> None:
         bot.dbgg_token = load_config.dbgg_token
         bot.topgg_token = load_config.topgg_token
         extensions.append("jishaku")
-        extensions.append("cogs.listing")
+        if cluster_id is None or cluster_id == 0:
+            # One cluster posts the count for all of them
+            extensions.append("cogs.listing")
     logger.info("Loading extensions...")
     for extension in extensions:
         bot.load_extension(extension)
     bot.run(load_config.token)
 
 
+def run() -> None:
+    if load_config.cluster_workers > 1:
+        run_cluster(
+            run_bot,
+            token=load_config.token,
+            workers=load_config.cluster_workers,
+            shard_count=load_config.shard_count,
+        )
+    else:
+        # With no shard count discord.py uses the recommended one
+        run_bot(shard_count=load_config.shard_count or None)
+
+
 if __name__ == "__main__":
     run()
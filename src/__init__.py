@@ -1,3 +1,3 @@
-from .cache import PartialGuildCache
+from .cache import LoggingChannelCache, PartialGuildCache
 from .context import Context
 from .hooks_and_logging import ServerLogger, send_log_once
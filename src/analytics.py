@@ -1,17 +1,119 @@
-from typing import Awaitable
+import asyncio
+import logging
+
+from collections import deque
+from typing import Deque, Dict, List, Optional
 
 from discord.ext import commands
+from tortoise import timezone
 
 from src import Context, errors
 from src.models import CommandStatus, CommandUsageAnalytics
 
+logger = logging.getLogger(__name__)
+
+
+class AnalyticsQueue:
+    """Writes CommandUsageAnalytics rows in the background.
+
+    Rows are queued in memory and written with bulk_create once batch_size rows
+    are waiting or every flush_interval seconds, so commands don't wait on the
+    INSERT. When max_size rows are already waiting new rows are dropped.
+    """
+
+    def __init__(self, max_size: int, batch_size: int, flush_interval: float) -> None:
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: Deque[CommandUsageAnalytics] = deque()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional["asyncio.Future[None]"] = None
+        self._closing = False
+        self.queued = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def record(
+        self,
+        guild_id: Optional[int],
+        command_name: List[Optional[str]],
+        slash: bool,
+        success: CommandStatus = CommandStatus.SUCCESS,
+    ) -> None:
+        if len(self._queue) >= self.max_size:
+            self.dropped += 1
+            return
+        self._queue.append(
+            CommandUsageAnalytics(
+                guild_id=guild_id,
+                command_name=command_name,
+                slash=slash,
+                success=success,
+                timestamp=timezone.now(),  # Not when the row is written
+            )
+        )
+        self.queued += 1
+        if len(self._queue) >= self.batch_size and self._wakeup is not None:
+            self._wakeup.set()
+
+    def metrics(self) -> Dict[str, int]:
+        return {
+            "waiting": len(self._queue),
+            "queued": self.queued,
+            "dropped": self.dropped,
+            "written": self.written,
+            "failed": self.failed,
+        }
+
+    def start(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self) -> None:
+        assert self._wakeup is not None
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        while len(self._queue) > 0:
+            batch = [
+                self._queue.popleft()
+                for _ in range(min(self.batch_size, len(self._queue)))
+            ]
+            try:
+                await CommandUsageAnalytics.bulk_create(batch)
+            except Exception:
+                self.failed += len(batch)
+                logger.error("Failed to write command analytics", exc_info=True)
+            else:
+                self.written += len(batch)
+
+    async def close(self) -> None:
+        # Lets the current flush finish, then writes anything left
+        self._closing = True
+        if self._task is not None:
+            assert self._wakeup is not None
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
 
-def success_analytics(ctx: Context, cancelled=False) -> Awaitable:
+def success_analytics(ctx: Context, cancelled: bool = False) -> None:
     if cancelled:
         success = CommandStatus.USER_CANCELLED
     else:
         success = CommandStatus.SUCCESS
-    return CommandUsageAnalytics.create(
+    ctx.bot.analytics.record(
         guild_id=ctx.guild.id if ctx.guild is not None else None,
         command_name=[*ctx.invoked_parents, ctx.invoked_with],
         slash=False,
@@ -43,226 +43,389 @@ This file incorporates work covered by the following copyright and permission no
 
 from __future__ import annotations
 
-from typing import Any, Dict, Hashable, NamedTuple, Optional, Union
+import asyncio
+import time
+
+from array import array
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+)
 
 from load_config import default_prefix
-from src import errors
-from src.models import Guild
+from src import errors, metrics
+from src.invalidation import InvalidationBus
+from src.models import (
+    create_guild_rows,
+    fetch_guild_rows,
+    fetch_logging_channel_row,
+    update_guild_row,
+)
 
+NIL = -1  # Marks the end of a list in the link arrays
 
-class CacheNode:
-    def __init__(
-        self,
-        key: Hashable,
-        value: Any,
-        freq_node: Optional[FreqNode],
-        pre: Optional[CacheNode],
-        next: Optional[CacheNode],
-    ) -> None:
-        self.key = key
-        self.value = value
-        self.freq_node = freq_node
-        self.pre = pre  # previous CacheNode
-        self.next = next  # next CacheNode
-
-    def free_myself(self) -> None:
-        if self.freq_node is None:
-            raise errors.CacheError("CacheNode outside of a FreqNode")
-        if self.freq_node.cache_head == self.freq_node.cache_tail:
-            self.freq_node.cache_head = self.freq_node.cache_tail = None
-        elif self.freq_node.cache_head == self:
-            assert self.next is not None
-            self.next.pre = None
-            self.freq_node.cache_head = self.next
-        elif self.freq_node.cache_tail == self:
-            assert self.pre is not None
-            self.pre.next = None
-            self.freq_node.cache_tail = self.pre
-        else:
-            assert self.next is not None and self.pre is not None
-            self.pre.next = self.next
-            self.next.pre = self.pre
-
-        self.pre = None
-        self.next = None
-        self.freq_node = None
-
-
-class FreqNode:
-    def __init__(
-        self, freq: int, pre: Optional[FreqNode], next: Optional[FreqNode]
-    ) -> None:
-        self.freq = freq
-        self.pre = pre  # previous FreqNode
-        self.next = next  # next FreqNode
-        self.cache_head: Optional[
-            CacheNode
-        ] = None  # CacheNode head under this FreqNode
-        self.cache_tail: Optional[
-            CacheNode
-        ] = None  # CacheNode tail under this FreqNNode
-
-    def count_caches(self) -> Union[int, str]:
-        if self.cache_head is None and self.cache_tail is None:
-            return 0
-        elif self.cache_head == self.cache_tail:
-            return 1
-        else:
-
-            return "2+"
-
-    def is_zero_length(self) -> bool:
-        return self.cache_head is None and self.cache_tail is None
-
-    def remove(self) -> None:
-        if self.pre is not None:
-            self.pre.next = self.next
-        if self.next is not None:
-            self.next.pre = self.pre
-
-        self.pre = self.next = self.cache_head = self.cache_tail = None
-
-    def pop_head_cache(self) -> Optional[CacheNode]:
-        if self.cache_head is None and self.cache_tail is None:
-            return None
-        elif self.cache_head == self.cache_tail:
-            cache_head = self.cache_head
-            self.cache_head = self.cache_tail = None
-            return cache_head
-        else:
-            assert self.cache_head is not None
-            assert self.cache_head.next is not None
-            cache_head = self.cache_head
-            self.cache_head.next.pre = None
-            self.cache_head = self.cache_head.next
-            return cache_head
-
-    def append_cache_to_tail(self, cache_node: CacheNode) -> None:
-        cache_node.freq_node = self
-
-        if self.cache_head is None and self.cache_tail is None:
-            self.cache_head = self.cache_tail = cache_node
-        else:
-            assert self.cache_tail is not None
-            cache_node.pre = self.cache_tail
-            cache_node.next = None
-            self.cache_tail.next = cache_node
-            self.cache_tail = cache_node
-
-    def insert_after_me(self, freq_node: FreqNode) -> None:
-        freq_node.pre = self
-        freq_node.next = self.next
 
-        if self.next is not None:
-            self.next.pre = freq_node
-
-        self.next = freq_node
-
-    def insert_before_me(self, freq_node: FreqNode) -> None:
-        if self.pre is not None:
-            self.pre.next = freq_node
-
-        freq_node.pre = self.pre
-        freq_node.next = self
-        self.pre = freq_node
+class BaseLFUCache:
+    """An O(1) LFU cache stored in preallocated parallel arrays.
 
+    Every cached key lives in a slot, an index into the ``_keys`` / ``_values``
+    lists and the ``_slot_*`` link arrays. Slots with the same use count are kept
+    in a doubly linked list under a frequency bucket, and the buckets form a
+    doubly linked list sorted by frequency. Links are plain integers, so nothing
+    is allocated on a hit, and freed slots and buckets are chained into free lists
+    to be reused.
+    """
 
-class BaseLFUCache:
     def __init__(self, capacity: int, drop_amount: int) -> None:
-        self.cache: Dict[Hashable, CacheNode] = {}  # {key: cache_node}
+        self.cache: Dict[Hashable, int] = {}  # {key: slot}
         self.capacity = capacity
-        self.freq_link_head: Optional[FreqNode] = None
         self.drop_amount = drop_amount
         if drop_amount > capacity:
             pass
             # raise
+        size = max(capacity, 1)
+
+        self._keys: List[Optional[Hashable]] = [None] * size
+        self._values: List[Any] = [None] * size
+        self._slot_bucket = array("i", [NIL]) * size
+        self._slot_pre = array("i", [NIL]) * size  # previous slot in the bucket
+        self._slot_next = array("i", [NIL]) * size  # next slot in the bucket
+        self._free_slot = NIL  # Freed slots, chained through _slot_next
+        self._unused_slot = 0  # Slots from here on have never been used
+
+        # There can never be more non empty buckets than there are slots
+        self._bucket_freq = array("q", [0]) * size
+        self._bucket_head = array("i", [NIL]) * size  # oldest slot in the bucket
+        self._bucket_tail = array("i", [NIL]) * size  # newest slot in the bucket
+        self._bucket_pre = array("i", [NIL]) * size  # bucket with a lower freq
+        self._bucket_next = array("i", [NIL]) * size  # bucket with a higher freq
+        self._free_bucket = NIL  # Freed buckets, chained through _bucket_next
+        self._unused_bucket = 0
+        self.freq_link_head = NIL  # bucket with the lowest freq
+
+        # Misses that are being fetched, so concurrent misses share one fetch
+        self._fetching: Dict[Hashable, asyncio.Future[Any]] = {}
+        # Bumped when a key being fetched is set or removed, the fetch is then stale
+        self._generations: Dict[Hashable, int] = {}
+        self.coalesced_waiters = 0  # Misses that waited on another miss's fetch
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.cache)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.cache
 
     async def get(self, key: Hashable) -> Any:
-        if key in self.cache:
-            cache_node = self.cache[key]
-            freq_node = cache_node.freq_node
-            if freq_node is None:
-                raise errors.CacheError("CacheNode outside of a FreqNode")
-            value = cache_node.value
-
-            self.move_forward(cache_node, freq_node)
-
+        slot = self.cache.get(key)
+        if slot is None:
+            return await self._get_missing(key)
+        self.hits += 1
+        self.move_forward(slot)
+        return self._values[slot]
+
+    def get_nowait(self, key: Hashable, default: Any = None) -> Any:
+        # Hit path without a coroutine, default is returned on a miss
+        slot = self.cache.get(key)
+        if slot is None:
+            return default
+        self.hits += 1
+        self.move_forward(slot)
+        return self._values[slot]
+
+    async def _get_missing(self, key: Hashable) -> Any:
+        # Misses are counted here, get_nowait misses are followed by a get
+        self.misses += 1
+        fetching = self._fetching.get(key)
+        if fetching is not None:
+            self.coalesced_waiters += 1
+            # Shielded so that one waiter being cancelled doesn't cancel the fetch
+            value = await asyncio.shield(fetching)
+            slot = self.cache.get(key)
+            if slot is not None:
+                self.move_forward(slot)
             return value
-        else:
-            new_data = await self.fetch(key)
+
+        fetching = asyncio.get_event_loop().create_future()
+        self._fetching[key] = fetching
+        self._generations[key] = 0
+        try:
+            with metrics.timer("cache_miss_seconds", cache=type(self).__name__):
+                new_data = await self.fetch(key)
+                while self._generations[key] != 0 and key not in self.cache:
+                    # Invalidated during the fetch, what was fetched may be old
+                    self._generations[key] = 0
+                    new_data = await self.fetch(key)
+        except asyncio.CancelledError:
+            fetching.cancel()
+            raise
+        except Exception as e:
+            fetching.set_exception(e)
+            fetching.exception()  # Mark as retrieved, there may be no waiters
+            raise
+        finally:
+            del self._fetching[key]
+            generation = self._generations.pop(key)
+        if generation == 0:
             self.set(key, new_data)
-            return await self.get(key)  # To increment freq once
+        # Otherwise it was set during the fetch, to something newer than new_data
+        slot = self.cache[key]
+        self.move_forward(slot)  # To increment freq once
+        value = self._values[slot]
+        fetching.set_result(value)
+        return value
 
     async def fetch(self, key: Hashable) -> Any:
         # for use when the key is not in the cache, empty to allow for different data types
         return None
 
     def set(self, key: Hashable, value: Any) -> None:
-        if key not in self.cache:
+        if key in self._generations:
+            self._generations[key] += 1
+        slot = self.cache.get(key)
+        if slot is None:
             if len(self.cache) >= self.capacity:
                 self.dump_cache()
 
             self.create_cache(key, value)
         else:
-            cache_node = self.cache[key]
-            freq_node = cache_node.freq_node
-            if freq_node is None:
-                raise errors.CacheError("CacheNode outside of a FreqNode")
-            cache_node.value = value
-
-            self.move_forward(cache_node, freq_node)
-
-    def move_forward(self, cache_node: CacheNode, freq_node: FreqNode) -> None:
-        if freq_node.next is None or freq_node.next.freq != freq_node.freq + 1:
-            target_freq_node = FreqNode(freq_node.freq + 1, None, None)
-            target_empty = True
+            self._values[slot] = value
+
+            self.move_forward(slot)
+
+    def metrics(self) -> Dict[str, int]:
+        return {
+            "size": len(self.cache),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced_waiters": self.coalesced_waiters,
+        }
+
+    def move_forward(self, slot: int) -> None:
+        bucket = self._slot_bucket[slot]
+        freq = self._bucket_freq[bucket] + 1
+        target = self._bucket_next[bucket]
+        has_target = target != NIL and self._bucket_freq[target] == freq
+
+        if self._bucket_head[bucket] == self._bucket_tail[bucket]:
+            # The slot is alone in its bucket
+            if not has_target:
+                self._bucket_freq[bucket] = freq  # Reuse the bucket in place
+                return
+            self._unlink_slot(slot)
+            self._release_bucket(bucket)
         else:
-            target_freq_node = freq_node.next
-            target_empty = False
-        cache_node.free_myself()
-        target_freq_node.append_cache_to_tail(cache_node)
+            self._unlink_slot(slot)
+            if not has_target:
+                target = self._new_bucket(freq, bucket, target)
+        self._append_slot(slot, target)
 
-        if target_empty:
-            freq_node.insert_after_me(target_freq_node)
+    def dump_cache(self) -> None:
+        # Always drop at least one, otherwise the arrays would overflow
+        for _ in range(max(self.drop_amount, 1)):
+            bucket = self.freq_link_head
+            if bucket == NIL:
+                return  # Cache empty
+            self._drop_slot(self._bucket_head[bucket])
 
-        if freq_node.is_zero_length():
-            if self.freq_link_head == freq_node:
-                self.freq_link_head = target_freq_node
+    def remove(self, key: Hashable) -> None:
+        if key in self._generations:
+            self._generations[key] += 1
+        slot = self.cache.get(key)
+        if slot is not None:
+            self._drop_slot(slot)
 
-            freq_node.remove()
+    def clear(self) -> None:
+        for key in self._generations:
+            self._generations[key] += 1
+        for slot in list(self.cache.values()):
+            self._drop_slot(slot)
 
-    def dump_cache(self) -> None:
-        head_freq_node = self.freq_link_head
+    def create_cache(self, key: Hashable, value: Any) -> None:
+        slot = self._free_slot
+        if slot == NIL:
+            slot = self._unused_slot
+            self._unused_slot += 1
+        else:
+            self._free_slot = self._slot_next[slot]
+        self._keys[slot] = key
+        self._values[slot] = value
+        self.cache[key] = slot
+
+        bucket = self.freq_link_head
+        if bucket == NIL or self._bucket_freq[bucket] != 0:
+            bucket = self._new_bucket(0, NIL, bucket)
+        self._append_slot(slot, bucket)
+
+    def _append_slot(self, slot: int, bucket: int) -> None:
+        tail = self._bucket_tail[bucket]
+        self._slot_bucket[slot] = bucket
+        self._slot_pre[slot] = tail
+        self._slot_next[slot] = NIL
+        if tail == NIL:
+            self._bucket_head[bucket] = slot
+        else:
+            self._slot_next[tail] = slot
+        self._bucket_tail[bucket] = slot
+
+    def _unlink_slot(self, slot: int) -> None:
+        bucket = self._slot_bucket[slot]
+        pre = self._slot_pre[slot]
+        next = self._slot_next[slot]
+        if pre == NIL:
+            self._bucket_head[bucket] = next
+        else:
+            self._slot_next[pre] = next
+        if next == NIL:
+            self._bucket_tail[bucket] = pre
+        else:
+            self._slot_pre[next] = pre
+
+    def _drop_slot(self, slot: int) -> None:
+        bucket = self._slot_bucket[slot]
+        self._unlink_slot(slot)
+        if self._bucket_head[bucket] == NIL:
+            self._release_bucket(bucket)
+
+        del self.cache[self._keys[slot]]
+        self._keys[slot] = self._values[slot] = None
+        self._slot_next[slot] = self._free_slot
+        self._free_slot = slot
+
+    def _new_bucket(self, freq: int, pre: int, next: int) -> int:
+        bucket = self._free_bucket
+        if bucket == NIL:
+            bucket = self._unused_bucket
+            self._unused_bucket += 1
+        else:
+            self._free_bucket = self._bucket_next[bucket]
+        self._bucket_freq[bucket] = freq
+        self._bucket_head[bucket] = self._bucket_tail[bucket] = NIL
+        self._bucket_pre[bucket] = pre
+        self._bucket_next[bucket] = next
+        if pre == NIL:
+            self.freq_link_head = bucket
+        else:
+            self._bucket_next[pre] = bucket
+        if next != NIL:
+            self._bucket_pre[next] = bucket
+        return bucket
+
+    def _release_bucket(self, bucket: int) -> None:
+        pre = self._bucket_pre[bucket]
+        next = self._bucket_next[bucket]
+        if pre == NIL:
+            self.freq_link_head = next
+        else:
+            self._bucket_next[pre] = next
+        if next != NIL:
+            self._bucket_pre[next] = pre
+        self._bucket_next[bucket] = self._free_bucket
+        self._free_bucket = bucket
 
-        for cache in range(self.drop_amount):
-            if head_freq_node is None:
-                return  # Cache empty
-            if head_freq_node.cache_head is None:
-                self.freq_link_head = head_freq_node.next
-                head_freq_node.remove()
-                head_freq_node = self.freq_link_head
-            else:
-                self.cache.pop(head_freq_node.cache_head.key)
-                head_freq_node.pop_head_cache()
-                if head_freq_node.is_zero_length():
-                    self.freq_link_head = head_freq_node.next
-                    head_freq_node.remove()
-                    head_freq_node = self.freq_link_head
 
-    def create_cache(self, key: Hashable, value: Any) -> None:
-        cache_node = CacheNode(key, value, None, None, None)
-        self.cache[key] = cache_node
+class TTLLFUCache(BaseLFUCache):
+    # Entries are fetched again once they are older than ttl seconds
 
-        if self.freq_link_head is None or self.freq_link_head.freq != 0:
-            new_freq_node = FreqNode(0, None, None)
-            new_freq_node.append_cache_to_tail(cache_node)
+    def __init__(self, capacity: int, drop_amount: int, ttl: float) -> None:
+        super().__init__(capacity, drop_amount)
+        self.ttl = ttl
 
-            if self.freq_link_head is not None:
-                self.freq_link_head.insert_before_me(new_freq_node)
+    async def get(self, key: Hashable) -> Any:
+        slot = self.cache.get(key)
+        if slot is not None and self._values[slot][0] <= time.monotonic():
+            self.remove(key)
+        expires, value = await super().get(key)
+        return value
+
+    def get_nowait(self, key: Hashable, default: Any = None) -> Any:
+        slot = self.cache.get(key)
+        if slot is None:
+            return default
+        if self._values[slot][0] <= time.monotonic():
+            self.remove(key)
+            return default
+        self.hits += 1
+        self.move_forward(slot)
+        return self._values[slot][1]
 
-            self.freq_link_head = new_freq_node
-        else:
-            self.freq_link_head.append_cache_to_tail(cache_node)
+    def set(self, key: Hashable, value: Any) -> None:
+        super().set(key, (time.monotonic() + self.ttl, value))
+
+
+class BatchLoader:
+    """Loads keys in batches, DataLoader style.
+
+    Keys requested within ``window`` seconds of each other (or within the same
+    event loop tick if ``window`` is 0) are loaded with one ``load_many`` call.
+    """
+
+    def __init__(
+        self,
+        load_many: Callable[[List[Any]], Awaitable[Dict[Any, Any]]],
+        window: float = 0,
+        max_batch_size: int = 500,
+    ) -> None:
+        self.load_many = load_many
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._pending: Dict[Hashable, asyncio.Future[Any]] = {}
+        self._handle: Optional[asyncio.Handle] = None
+        self.batches = 0
+        self.loaded = 0
+
+    def load(self, key: Hashable) -> asyncio.Future[Any]:
+        future = self._pending.get(key)
+        if future is not None:
+            return future
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._pending[key] = future
+        if len(self._pending) >= self.max_batch_size:
+            self._dispatch()
+        elif self._handle is None:
+            if self.window > 0:
+                self._handle = loop.call_later(self.window, self._dispatch)
+            else:
+                self._handle = loop.call_soon(self._dispatch)
+        return future
+
+    def _dispatch(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        batch, self._pending = self._pending, {}
+        asyncio.ensure_future(self._load_batch(batch))
+
+    async def _load_batch(self, batch: Dict[Hashable, asyncio.Future[Any]]) -> None:
+        self.batches += 1
+        self.loaded += len(batch)
+        try:
+            results = await self.load_many(list(batch))
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+                    future.exception()  # Mark as retrieved, the caller may be gone
+            return
+        for key, future in batch.items():
+            if future.done():
+                continue  # Cancelled by the caller
+            if key in results:
+                future.set_result(results[key])
+            else:
+                future.set_exception(errors.CacheError(f"{key} was not loaded"))
 
 
 class GuildTuple(NamedTuple):
@@ -278,34 +441,97 @@ class PartialGuildCache(BaseLFUCache):
         # Fetch was also overridden, therefore all values will be of type GuildTuple
         return data
 
+    def get_nowait(  # type: ignore[override]
+        self, key: int, default: Optional[GuildTuple] = None
+    ) -> Optional[GuildTuple]:
+        data = super().get_nowait(key, default)
+        assert data is None or isinstance(data, GuildTuple)
+        return data
+
+    def __init__(
+        self,
+        capacity: int,
+        drop_amount: int,
+        batch_window: float = 0,
+        invalidation: Optional[InvalidationBus] = None,
+    ) -> None:
+        super().__init__(capacity, drop_amount)
+        self.loader = BatchLoader(self.fetch_many, window=batch_window)
+        # Other processes are told about updates so they don't keep stale guilds
+        self.invalidation = invalidation
+        if invalidation is not None:
+            invalidation.subscribe("guild", self.remove, self.clear)
+
     async def fetch(self, key: int) -> GuildTuple:  # type: ignore[override]
-        data = await Guild.get_or_create(
-            defaults={"management_role_id": None, "prefix": default_prefix}, id=key
-        )
-        data = data[0]
-        small_data = GuildTuple(
-            id=data.id, management_role_id=data.management_role_id, prefix=data.prefix
-        )
-        return small_data
+        data = await self.loader.load(key)
+        assert isinstance(data, GuildTuple)
+        return data
+
+    async def fetch_many(self, keys: Sequence[int]) -> Dict[int, GuildTuple]:
+        # Like fetch, but for many guilds in one query
+        with metrics.timer("db_lookup_seconds", model="Guild", query="filter"):
+            rows = await fetch_guild_rows(keys)
+        found = {row[0]: GuildTuple(*row) for row in rows}
+        missing = [key for key in keys if key not in found]
+        if len(missing) > 0:
+            with metrics.timer("db_lookup_seconds", model="Guild", query="create"):
+                rows = await create_guild_rows(missing, default_prefix)
+            found.update((row[0], GuildTuple(*row)) for row in rows)
+        return found
+
+    async def warm(self, guild_ids: Iterable[int], batch_size: int = 500) -> int:
+        # Only fills free space, so nothing that is already cached is dropped
+        room = max(self.capacity - len(self.cache), 0)
+        to_load = [key for key in guild_ids if key not in self.cache][:room]
+        for start in range(0, len(to_load), batch_size):
+            data = await self.fetch_many(to_load[start : start + batch_size])
+            for key, value in data.items():
+                if key not in self.cache:  # May have been fetched in the meantime
+                    self.set(key, value)
+        return len(to_load)
 
     async def update_prefix(self, guild_id: int, prefix: str) -> GuildTuple:
-        data = await Guild.get(id=guild_id)
-        data.prefix = prefix
-        await data.save()
-        new = GuildTuple(
-            id=data.id, management_role_id=data.management_role_id, prefix=data.prefix
-        )
+        with metrics.timer("db_lookup_seconds", model="Guild", query="update"):
+            row = await update_guild_row(guild_id, "prefix", prefix)
+        if self.invalidation is not None:
+            await self.invalidation.publish("guild", guild_id)
+        new = GuildTuple(*row)
         self.set(guild_id, new)
         return new
 
     async def update_management_role(
         self, guild_id: int, management_role_id: Optional[int]
     ) -> GuildTuple:
-        data = await Guild.get(id=guild_id)
-        data.management_role_id = management_role_id
-        await data.save()
-        new = GuildTuple(
-            id=data.id, management_role_id=data.management_role_id, prefix=data.prefix
-        )
+        with metrics.timer("db_lookup_seconds", model="Guild", query="update"):
+            row = await update_guild_row(
+                guild_id, "management_role_id", management_role_id
+            )
+        if self.invalidation is not None:
+            await self.invalidation.publish("guild", guild_id)
+        new = GuildTuple(*row)
         self.set(guild_id, new)
         return new
+
+
+class LoggingChannelTuple(NamedTuple):
+    channel_id: int
+    webhook_id: Optional[int]
+    webhook_token: Optional[str]
+
+
+class LoggingChannelCache(TTLLFUCache):
+    # Keyed by (guild_id, logger_type), None is cached for guilds without that logger
+    async def get(  # type: ignore[override]
+        self, key: Tuple[int, str]
+    ) -> Optional[LoggingChannelTuple]:
+        data = await super().get(key)
+        assert data is None or isinstance(data, LoggingChannelTuple)
+        return data
+
+    async def fetch(  # type: ignore[override]
+        self, key: Tuple[int, str]
+    ) -> Optional[LoggingChannelTuple]:
+        guild_id, logger_type = key
+        with metrics.timer("db_lookup_seconds", model="LoggingChannel", query="get"):
+            row = await fetch_logging_channel_row(guild_id, logger_type)
+        return LoggingChannelTuple(*row) if row is not None else None
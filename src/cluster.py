@@ -0,0 +1,266 @@
+# src/cluster.py
+
+"""
+Message Manager - A bot for discord
+Copyright (C) 2020-2021 AnotherCat
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Runs the bot as several worker processes, each with its own range of shards.
+
+Every worker is a normal AutoShardedBot with its own caches, discord sends the
+events for a guild to the shard that owns it so each worker only ever sees its
+own guilds. Caches are kept coherent across workers with the invalidation bus.
+The supervisor adds up the guild counts from the heartbeats, so that the first
+worker can post the count for the whole bot to the listing sites.
+"""
+
+import asyncio
+import ctypes
+import logging
+import multiprocessing
+import queue
+import signal
+import time
+
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_INTERVAL = 15  # Seconds between heartbeats from a worker
+HEARTBEAT_TIMEOUT = 120  # Workers that are silent for this long are restarted
+STARTUP_GRACE = 300  # Logging in all the shards of a worker can take a while
+MAX_RESTART_DELAY = 300
+
+
+def shard_id_for_guild(guild_id: int, shard_count: int) -> int:
+    # https://discord.com/developers/docs/topics/gateway#sharding-sharding-formula
+    return (guild_id >> 22) % shard_count
+
+
+def shard_ranges(shard_count: int, workers: int) -> List[List[int]]:
+    # Contiguous ranges, the first workers get one more shard when it's uneven
+    per_worker, extra = divmod(shard_count, workers)
+    ranges = []
+    start = 0
+    for cluster_id in range(workers):
+        end = start + per_worker + (1 if cluster_id < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return [shard_ids for shard_ids in ranges if len(shard_ids) > 0]
+
+
+async def fetch_recommended_shards(token: str) -> int:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(
+            "https://discord.com/api/v9/gateway/bot",
+            headers={"Authorization": f"Bot {token}"},
+        ) as r:
+            r.raise_for_status()
+            data = await r.json()
+    return int(data["shards"])
+
+
+class Heartbeat(NamedTuple):
+    cluster_id: int
+    sent_at: float
+    guilds: int
+    latency: float
+    ready: bool
+
+
+class Worker:
+    def __init__(self, cluster_id: int, shard_ids: List[int]) -> None:
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.process: Optional[multiprocessing.process.BaseProcess] = None
+        self.started_at = 0.0
+        self.restarts = 0
+        self.restart_delay = 1.0
+        self.restart_at: Optional[float] = None
+        self.heartbeat: Optional[Heartbeat] = None
+        self.heartbeats: Optional["multiprocessing.Queue[Heartbeat]"] = None
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def last_seen(self) -> float:
+        if self.heartbeat is None:
+            return self.started_at
+        return self.heartbeat.sent_at
+
+
+class ClusterSupervisor:
+    """Starts a worker process per shard range and keeps them running.
+
+    ``target`` is called in the worker as
+    ``target(cluster_id=, shard_ids=, shard_count=, heartbeats=, guild_count=)``
+    and must be importable from the worker, workers are started with the spawn
+    method. Workers that exit or stop sending heartbeats are restarted with a
+    backoff.
+
+    Each worker has a heartbeat queue of its own, a worker that is killed while
+    writing to a queue can leave it unusable. ``guild_count`` is shared memory
+    with the guild count of every worker added up, 0 until all of them are ready.
+    """
+
+    def __init__(
+        self, target: Callable[..., Any], shard_count: int, workers: int
+    ) -> None:
+        self.target = target
+        self.shard_count = shard_count
+        self.context = multiprocessing.get_context("spawn")
+        # No lock, so a killed worker can't leave it locked. Only this process writes
+        self.guild_count = self.context.RawValue(ctypes.c_longlong, 0)
+        self.workers = [
+            Worker(cluster_id, shard_ids)
+            for cluster_id, shard_ids in enumerate(shard_ranges(shard_count, workers))
+        ]
+        self._stopping = False
+
+    def start_worker(self, worker: Worker) -> None:
+        if worker.heartbeats is not None:
+            worker.heartbeats.close()
+        worker.heartbeats = self.context.Queue()
+        worker.process = self.context.Process(
+            target=self.target,
+            kwargs={
+                "cluster_id": worker.cluster_id,
+                "shard_ids": worker.shard_ids,
+                "shard_count": self.shard_count,
+                "heartbeats": worker.heartbeats,
+                "guild_count": self.guild_count,
+            },
+            name=f"cluster-{worker.cluster_id}",
+        )
+        worker.process.start()
+        worker.started_at = time.time()
+        worker.heartbeat = None
+        worker.restart_at = None
+        logger.info(
+            f"Started cluster {worker.cluster_id} with shards {worker.shard_ids}"
+        )
+
+    def stop(self, *args: Any) -> None:
+        self._stopping = True
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for worker in self.workers:
+            self.start_worker(worker)
+        last_report = time.time()
+        try:
+            while not self._stopping:
+                time.sleep(1)
+                self.receive_heartbeats()
+                self.check_workers()
+                self.update_guild_count()
+                if time.time() - last_report >= HEARTBEAT_INTERVAL * 4:
+                    last_report = time.time()
+                    logger.info(f"Cluster health: {self.health()}")
+        finally:
+            self.shutdown()
+
+    def receive_heartbeats(self) -> None:
+        for worker in self.workers:
+            if worker.heartbeats is None or not worker.alive:
+                continue
+            try:
+                while True:
+                    worker.heartbeat = worker.heartbeats.get_nowait()
+            except queue.Empty:
+                pass
+
+    def update_guild_count(self) -> None:
+        # Only whole counts are shared, a partial one would be posted as too low
+        health = self.health()
+        if health["ready"] == len(self.workers):
+            self.guild_count.value = health["guilds"]
+
+    def check_workers(self) -> None:
+        now = time.time()
+        for worker in self.workers:
+            if worker.restart_at is not None:
+                if now >= worker.restart_at:
+                    self.start_worker(worker)
+                continue
+            assert worker.process is not None
+            if not worker.alive:
+                logger.error(
+                    f"Cluster {worker.cluster_id} exited with code {worker.process.exitcode}"
+                )
+                self.schedule_restart(worker)
+                continue
+            grace = HEARTBEAT_TIMEOUT if worker.heartbeat is not None else STARTUP_GRACE
+            if now - worker.last_seen() > grace:
+                logger.error(f"Cluster {worker.cluster_id} stopped responding")
+                worker.process.kill()
+                worker.process.join()
+                self.schedule_restart(worker)
+
+    def schedule_restart(self, worker: Worker) -> None:
+        # Workers that crash straight after starting back off exponentially
+        if time.time() - worker.started_at > MAX_RESTART_DELAY:
+            worker.restart_delay = 1.0
+        else:
+            worker.restart_delay = min(worker.restart_delay * 2, MAX_RESTART_DELAY)
+        worker.restarts += 1
+        worker.restart_at = time.time() + worker.restart_delay
+        logger.info(
+            f"Restarting cluster {worker.cluster_id} in {worker.restart_delay:.0f}s"
+        )
+
+    def shutdown(self) -> None:
+        for worker in self.workers:
+            if worker.alive:
+                assert worker.process is not None
+                worker.process.terminate()  # SIGTERM, the bot closes cleanly
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.join(timeout=30)
+                if worker.process.is_alive():
+                    worker.process.kill()
+
+    def health(self) -> Dict[str, Any]:
+        now = time.time()
+        clusters = {}
+        for worker in self.workers:
+            heartbeat = worker.heartbeat
+            clusters[worker.cluster_id] = {
+                "shards": worker.shard_ids,
+                "alive": worker.alive,
+                "ready": worker.alive and heartbeat is not None and heartbeat.ready,
+                "restarts": worker.restarts,
+                "guilds": heartbeat.guilds if heartbeat is not None else 0,
+                "latency": heartbeat.latency if heartbeat is not None else None,
+                "last_seen": round(now - worker.last_seen(), 1),
+            }
+        return {
+            "clusters": clusters,
+            "guilds": sum(cluster["guilds"] for cluster in clusters.values()),
+            "ready": sum(1 for cluster in clusters.values() if cluster["ready"]),
+        }
+
+
+def run_cluster(
+    target: Callable[..., Any], token: str, workers: int, shard_count: int
+) -> None:
+    if shard_count <= 0:
+        shard_count = asyncio.run(fetch_recommended_shards(token))
+        logger.info(f"Using the recommended shard count of {shard_count}")
+    ClusterSupervisor(target, shard_count, workers).run()
@@ -0,0 +1,172 @@
+# src/component_listeners.py
+
+"""
+Message Manager - A bot for discord
+Copyright (C) 2020-2021 AnotherCat
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import heapq
+import itertools
+import time
+
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+if TYPE_CHECKING:
+    from src.interactions import ComponentInteraction
+
+# asyncio.wait_for times the future out itself, the heap is only for futures it
+# was never awaited on, so give it time to raise TimeoutError first
+EXPIRY_GRACE = 5.0
+
+Check = Callable[["ComponentInteraction"], Awaitable[bool]]
+
+
+class Listener(NamedTuple):
+    future: "asyncio.Future[Any]"
+    check: Check
+
+
+class Registration(NamedTuple):
+    custom_ids: Tuple[str, ...]
+    registered_at: float
+    deadline: Optional[float]
+
+
+class ComponentListeners:
+    """Component listeners keyed by custom_id.
+
+    Every listener is removed by a done callback on its future, so listeners
+    that completed, were cancelled or timed out in asyncio.wait_for are gone
+    straight away. Deadlines are kept in a min-heap as well, which cancels
+    futures nobody is waiting on once their deadline has passed.
+    Heap entries for futures that already finished are skipped when they
+    reach the top instead of being searched for.
+    """
+
+    def __init__(self) -> None:
+        self.listeners: Dict[str, Listener] = {}
+        # Insertion ordered, so the first registration is the oldest
+        self.registrations: Dict["asyncio.Future[Any]", Registration] = {}
+        self._deadlines: List[Tuple[float, int, "asyncio.Future[Any]"]] = []
+        self._counter = itertools.count()
+        self._expiry_handle: Optional[asyncio.TimerHandle] = None
+        self._expiry_at: Optional[float] = None
+        self.registered = 0
+        self.completed = 0
+        self.expired = 0
+
+    def __len__(self) -> int:
+        return len(self.listeners)
+
+    def __contains__(self, custom_id: str) -> bool:
+        return custom_id in self.listeners
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.listeners)
+
+    def get(self, custom_id: str) -> Optional[Listener]:
+        return self.listeners.get(custom_id)
+
+    def add(
+        self,
+        custom_ids: Tuple[str, ...],
+        future: "asyncio.Future[Any]",
+        check: Check,
+        timeout: Optional[float] = None,
+    ) -> None:
+        loop = future.get_loop()
+        listener = Listener(future, check)
+        for custom_id in custom_ids:
+            self.listeners[custom_id] = listener
+        deadline = None if timeout is None else loop.time() + timeout + EXPIRY_GRACE
+        self.registrations[future] = Registration(
+            custom_ids, time.monotonic(), deadline
+        )
+        self.registered += 1
+        future.add_done_callback(self._on_done)
+        if deadline is not None:
+            heapq.heappush(self._deadlines, (deadline, next(self._counter), future))
+            if self._expiry_at is None or deadline < self._expiry_at:
+                self._schedule_expiry(loop, deadline)
+
+    def remove(self, custom_id: str) -> None:
+        self.listeners.pop(custom_id, None)
+
+    def _on_done(self, future: "asyncio.Future[Any]") -> None:
+        registration = self.registrations.pop(future, None)
+        if registration is None:
+            return
+        self.completed += 1
+        for custom_id in registration.custom_ids:
+            # The custom_id may have been registered again by a newer listener
+            listener = self.listeners.get(custom_id)
+            if listener is not None and listener.future is future:
+                del self.listeners[custom_id]
+
+    def _schedule_expiry(self, loop: asyncio.AbstractEventLoop, when: float) -> None:
+        if self._expiry_handle is not None:
+            self._expiry_handle.cancel()
+        self._expiry_at = when
+        self._expiry_handle = loop.call_at(when, self._expire, loop)
+
+    def _expire(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._expiry_handle = None
+        self._expiry_at = None
+        now = loop.time()
+        while len(self._deadlines) > 0:
+            deadline, _, future = self._deadlines[0]
+            if future.done():
+                heapq.heappop(self._deadlines)
+            elif deadline <= now:
+                heapq.heappop(self._deadlines)
+                self.expired += 1
+                future.cancel()  # The done callback removes the listeners
+            else:
+                self._schedule_expiry(loop, deadline)
+                break
+
+    def compact(self) -> None:
+        # Drops heap entries for futures that finished before their deadline
+        self._deadlines = [entry for entry in self._deadlines if not entry[2].done()]
+        heapq.heapify(self._deadlines)
+
+    def oldest_age(self) -> float:
+        for registration in self.registrations.values():
+            return time.monotonic() - registration.registered_at
+        return 0.0
+
+    def metrics(self) -> Dict[str, float]:
+        return {
+            "listeners": len(self.listeners),
+            "pending": len(self.registrations),
+            "deadlines": len(self._deadlines),
+            "oldest_age": self.oldest_age(),
+            "registered": self.registered,
+            "completed": self.completed,
+            "expired": self.expired,
+        }
@@ -23,11 +23,12 @@ from discord.ext import commands
 
 if TYPE_CHECKING:
     from main import Bot
-    from src.cache import GuildTuple
+    from src.cache import GuildTuple, PartialGuildCache
 else:
     # Avoid circlar imports
     Bot = None
     GuildTuple = None
+    PartialGuildCache = None
 
 
 class Context(commands.Context):
@@ -35,12 +36,17 @@ class Context(commands.Context):
 
     def __init__(self, **kwargs: Dict[str, Any]) -> None:
         super().__init__(**kwargs)  # type: ignore
-        self.guild_cache = self.bot.guild_cache
         self.guild_data: Optional[GuildTuple] = None
 
+    @property
+    def guild_cache(self) -> PartialGuildCache:
+        return self.bot.guild_cache
+
     async def fetch_guild_data(self) -> Optional[GuildTuple]:
         if self.guild is None:
             return None
         else:
-            self.guild_data = await self.guild_cache.get(self.guild.id)
+            self.guild_data = self.guild_cache.get_nowait(self.guild.id)
+            if self.guild_data is None:
+                self.guild_data = await self.guild_cache.get(self.guild.id)
             return self.guild_data
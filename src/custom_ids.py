@@ -0,0 +1,113 @@
+# src/custom_ids.py
+
+"""
+Message Manager - A bot for discord
+Copyright (C) 2020-2021 AnotherCat
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Signed component custom_ids.
+
+The custom_id carries the action, the author, the message the prompt is for and
+when it expires, signed with a HMAC so that users can't make their own. Any
+process can handle the component from the custom_id alone, without a listener.
+"""
+
+import base64
+import hashlib
+import hmac
+import time
+
+from typing import NamedTuple, Optional
+
+import load_config
+
+VERSION = "v1"
+SIGNATURE_LENGTH = 12  # bytes of the HMAC that are kept, 16 characters once encoded
+MAX_CUSTOM_ID_LENGTH = 100  # Discord's limit
+
+
+def _secret() -> bytes:
+    if load_config.component_secret:
+        return load_config.component_secret.encode()
+    # Every process shares the token, so they all derive the same secret
+    return hashlib.sha256(f"components:{load_config.token}".encode()).digest()
+
+
+SECRET = _secret()
+
+
+def _to_base36(number: int) -> str:
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    result = ""
+    while True:
+        number, remainder = divmod(number, 36)
+        result = digits[remainder] + result
+        if number == 0:
+            return result
+
+
+def _sign(payload: str) -> str:
+    digest = hmac.new(SECRET, payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:SIGNATURE_LENGTH]).decode()
+
+
+class CustomIdData(NamedTuple):
+    action: str
+    author_id: int
+    message_id: int
+    expires_at: int
+
+    @property
+    def expired(self) -> bool:
+        return time.time() >= self.expires_at
+
+
+def encode_custom_id(
+    action: str, author_id: int, message_id: int, expires_at: float
+) -> str:
+    if "." in action:
+        raise ValueError("Custom id actions can't contain '.'")
+    payload = ".".join(
+        (
+            VERSION,
+            action,
+            _to_base36(author_id),
+            _to_base36(message_id),
+            _to_base36(int(expires_at)),
+        )
+    )
+    custom_id = f"{payload}.{_sign(payload)}"
+    if len(custom_id) > MAX_CUSTOM_ID_LENGTH:
+        raise ValueError(f"Custom id for {action} is too long")
+    return custom_id
+
+
+def decode_custom_id(custom_id: str) -> Optional[CustomIdData]:
+    # None for custom ids that weren't made by encode_custom_id or were changed
+    parts = custom_id.split(".")
+    if len(parts) != 6 or parts[0] != VERSION:
+        return None
+    payload, signature = custom_id.rsplit(".", 1)
+    if not hmac.compare_digest(_sign(payload), signature):
+        return None
+    try:
+        return CustomIdData(
+            action=parts[1],
+            author_id=int(parts[2], 36),
+            message_id=int(parts[3], 36),
+            expires_at=int(parts[4], 36),
+        )
+    except ValueError:
+        return None
@@ -0,0 +1,131 @@
+# src/db.py
+
+"""
+Message Manager - A bot for discord
+Copyright (C) 2020-2021 AnotherCat
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Tortoise engine for postgres that keeps metrics on its connection pool.
+
+Used as ``"engine": "src.db"`` in the tortoise config. Every query outside a
+transaction acquires a connection from the pool, the time spent waiting for
+one and how many are in use show if DB_POOL_MAX is too small for the load.
+Every statement the ORM sends is timed as db_query_seconds, labelled by its
+table and kind, so queries from the cogs are included and not just the lookups
+in src.models.
+"""
+
+import functools
+import re
+import time
+
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from tortoise.backends.asyncpg.client import AsyncpgDBClient
+from tortoise.backends.base.client import PoolConnectionWrapper
+
+from src import metrics
+
+TABLE = re.compile(r'(?:FROM|INTO|UPDATE)\s+"?(\w+)"?', re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=512)
+def describe(query: str) -> Tuple[str, str]:
+    # The ORM uses parameters, so there are only so many different queries
+    kind = query.split(None, 1)[0].upper() if query.strip() else "UNKNOWN"
+    table = TABLE.search(query)
+    return (table.group(1) if table is not None else "unknown"), kind
+
+
+def query_timer(query: str) -> Union[metrics.Timer, metrics.NullTimer]:
+    table, kind = describe(query)
+    return metrics.timer("db_query_seconds", table=table, query=kind)
+
+
+class InstrumentedPoolConnectionWrapper(PoolConnectionWrapper):
+    def __init__(self, client: "InstrumentedAsyncpgDBClient") -> None:
+        super().__init__(client._pool)
+        self.client = client
+
+    async def __aenter__(self) -> Any:
+        client = self.client
+        saturated = client.in_use >= client.pool_maxsize
+        start = time.perf_counter()
+        connection = await super().__aenter__()
+        wait = time.perf_counter() - start
+        client.acquired(wait, saturated)
+        return connection
+
+    async def __aexit__(self, exc_type: Any, exc_val: Any, exc_tb: Any) -> None:
+        try:
+            await super().__aexit__(exc_type, exc_val, exc_tb)
+        finally:
+            self.client.in_use -= 1
+
+
+class InstrumentedAsyncpgDBClient(AsyncpgDBClient):
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.in_use = 0
+        self.max_in_use = 0
+        self.acquires = 0
+        self.saturated_acquires = 0  # Had to wait for another query to finish
+        self.wait_total = 0.0
+
+    def acquired(self, wait: float, saturated: bool) -> None:
+        self.in_use += 1
+        self.max_in_use = max(self.max_in_use, self.in_use)
+        self.acquires += 1
+        self.wait_total += wait
+        if saturated:
+            self.saturated_acquires += 1
+        metrics.observe("db_pool_wait_seconds", wait)
+
+    def acquire_connection(self) -> PoolConnectionWrapper:  # type: ignore[override]
+        return InstrumentedPoolConnectionWrapper(self)
+
+    async def execute_insert(self, query: str, values: list) -> Any:
+        with query_timer(query):
+            return await super().execute_insert(query, values)
+
+    async def execute_many(self, query: str, values: list) -> None:
+        with query_timer(query):
+            await super().execute_many(query, values)
+
+    async def execute_query(
+        self, query: str, values: Optional[list] = None
+    ) -> Tuple[int, List[dict]]:
+        with query_timer(query):
+            return await super().execute_query(query, values)
+
+    async def execute_query_dict(
+        self, query: str, values: Optional[list] = None
+    ) -> List[dict]:
+        with query_timer(query):
+            return await super().execute_query_dict(query, values)
+
+    def metrics(self) -> Dict[str, float]:
+        return {
+            "min_size": self.pool_minsize,
+            "max_size": self.pool_maxsize,
+            "in_use": self.in_use,
+            "max_in_use": self.max_in_use,
+            "acquires": self.acquires,
+            "saturated_acquires": self.saturated_acquires,
+            "wait_total": self.wait_total,
+        }
+
+
+client_class = InstrumentedAsyncpgDBClient
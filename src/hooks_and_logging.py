@@ -1,12 +1,52 @@
+import asyncio
+import logging
+
 from typing import List, Optional, Union
 
 import discord
 
-from discord import AsyncWebhookAdapter
+import load_config
 
 from main import Bot
-from src import errors
-from src.models import Channel, LoggingChannel
+from src import errors, metrics
+from src.http_scheduler import ScheduledWebhookAdapter
+from src.models import Channel, fetch_channel_webhook_row
+
+# Discord's limits for a single webhook message
+MAX_EMBEDS_PER_MESSAGE = 10
+MAX_EMBED_CHARACTERS = 6000
+MAX_FLUSH_TRIES = 3  # Before the logs that keep failing are dropped
+
+logger = logging.getLogger(__name__)
+
+
+def scheduled_webhook(bot: Bot, webhook_id: int, token: str) -> discord.Webhook:
+    # Log webhooks are sent through the scheduler, behind interactions
+    return discord.Webhook.partial(
+        id=webhook_id,
+        token=token,
+        adapter=ScheduledWebhookAdapter(bot.session, bot.http_scheduler),
+    )
+
+
+def chunk_embeds(embeds: List[discord.Embed]) -> List[List[discord.Embed]]:
+    chunks: List[List[discord.Embed]] = []
+    chunk: List[discord.Embed] = []
+    characters = 0
+    for embed in embeds:
+        embed_characters = len(embed)
+        if len(chunk) > 0 and (
+            len(chunk) >= MAX_EMBEDS_PER_MESSAGE
+            or characters + embed_characters > MAX_EMBED_CHARACTERS
+        ):
+            chunks.append(chunk)
+            chunk = []
+            characters = 0
+        chunk.append(embed)
+        characters += embed_characters
+    if len(chunk) > 0:
+        chunks.append(chunk)
+    return chunks
 
 
 async def create_webhook(
@@ -29,7 +69,7 @@ async def create_webhook(
     if len(existing_webhooks) == 0:
         try:
             webhook = await channel.create_webhook(
-                name=bot.user.name, avatar=await bot.user.avatar_url_as().read()
+                name=bot.user.name, avatar=await bot.get_avatar_bytes()
             )
             await Channel.update_or_create(
                 defaults={"webhook_token": webhook.token, "webhook_id": webhook.id},
@@ -40,7 +80,7 @@ async def create_webhook(
         return webhook
     elif len(existing_webhooks) == 1:
         webhook = existing_webhooks[0]
-        stored_webhook = await Channel.get_or_none(id=channel_id)
+        stored_webhook = await fetch_channel_webhook_row(channel_id)
         if webhook.token is None:
             await webhook.delete()
             return await create_webhook(channel_id, bot, attempt=attempt + 1)
@@ -57,7 +97,7 @@ async def create_webhook(
         else:
             return webhook
     else:  # More than one webhook by this bot in that channel. THIS SHOULD NOT HAPPEN
-        stored_webhook = await Channel.get_or_none(id=channel_id)
+        stored_webhook = await fetch_channel_webhook_row(channel_id)
         for webhook in existing_webhooks:
             if (
                 stored_webhook is None  # Nothing is stored, delete all
@@ -79,7 +119,19 @@ async def send_log_once(
     embeds: Optional[List[discord.Embed]] = None,
 ) -> None:
     channel_logger = await ServerLogger.get_logger(guild_id, bot, logger_type)
-    if channel_logger is not None:
+    if channel_logger is None:
+        return
+    if (
+        load_config.logging_batch_window > 0
+        and logger_type == "main"
+        and embeds
+        and content is None
+        and file is None
+        and not files
+    ):
+        channel_logger.queue_embeds(embeds)
+    else:
+        await channel_logger.flush()  # So that logs stay in order
         await channel_logger.send_log(
             content=content, embeds=embeds, files=files, file=file
         )
@@ -91,9 +143,11 @@ class ServerLogger:
         bot: Bot,
         logger_type: str,
         channel_id: int,
+        guild_id: int,
         webhook: Optional[discord.Webhook] = None,
     ) -> None:
         self.channel_id = channel_id
+        self.guild_id = guild_id
         self.bot = bot
         self.has_webhook = False
         self.logger_type = logger_type
@@ -101,28 +155,76 @@ class ServerLogger:
         if webhook is not None:
             self.has_webhook = True
             self.webhook = webhook
+        self.pending_embeds: List[discord.Embed] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._flush_lock = asyncio.Lock()
+        self.failed_flushes = 0
 
     @classmethod
     async def get_logger(cls, guild_id: int, bot: Bot, logger_type: str):  # type: ignore
-        logger = await LoggingChannel.get_or_none(
-            guild_id=guild_id, logger_type=logger_type
-        )
-        if logger is None:
+        logging_channel = await bot.logger_cache.get((guild_id, logger_type))
+        if logging_channel is None:
             return None
-        await logger.fetch_related("channel")
-        assert isinstance(logger.channel, Channel)
-        if (
-            logger.channel.webhook_id is not None
-            and logger.channel.webhook_token is not None
-        ):
-            webhook = discord.Webhook.partial(
-                id=logger.channel.webhook_id,
-                token=logger.channel.webhook_token,
-                adapter=AsyncWebhookAdapter(bot.session),
+        # Loggers are kept per channel so that their webhook (and its adapter) is reused
+        server_logger = bot.server_loggers.get(logging_channel.channel_id)
+        if server_logger is None:
+            webhook = None
+            if (
+                logging_channel.webhook_id is not None
+                and logging_channel.webhook_token is not None
+            ):
+                webhook = scheduled_webhook(
+                    bot, logging_channel.webhook_id, logging_channel.webhook_token
+                )
+            server_logger = cls(
+                bot, logger_type, logging_channel.channel_id, guild_id, webhook=webhook
             )
-            return cls(bot, logger_type, logger.channel_id, webhook=webhook)
-        else:
-            return cls(bot, logger_type, logger.channel_id)
+            bot.server_loggers[logging_channel.channel_id] = server_logger
+        return server_logger
+
+    async def invalidate_cache(self) -> None:
+        # The cached webhook is out of date once the webhook changes, in every process
+        await self.bot.invalidation.publish(
+            "logging_channel", (self.guild_id, self.logger_type)
+        )
+
+    def queue_embeds(self, embeds: List[discord.Embed]) -> None:
+        # Embeds queued within the batch window are sent together
+        self.pending_embeds.extend(embeds)
+        self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        if self._flush_handle is None:
+            self._flush_handle = self.bot.loop.call_later(
+                load_config.logging_batch_window,
+                lambda: self.bot.loop.create_task(self.flush()),
+            )
+
+    async def flush(self) -> None:
+        # Failures are logged and not raised, they belong to whatever queued the logs
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        async with self._flush_lock:
+            # More can be queued while sending, those are after these
+            for chunk in chunk_embeds(list(self.pending_embeds)):
+                try:
+                    await self.send_log(embeds=chunk)
+                except Exception:
+                    self.failed_flushes += 1
+                    if self.failed_flushes < MAX_FLUSH_TRIES:
+                        logger.warning(
+                            f"Failed to send logs to channel {self.channel_id}, retrying",
+                            exc_info=True,
+                        )
+                        self._schedule_flush()
+                        return
+                    logger.error(
+                        f"Dropping {len(chunk)} logs for channel {self.channel_id}",
+                        exc_info=True,
+                    )
+                self.failed_flushes = 0
+                del self.pending_embeds[: len(chunk)]
 
     async def send_log(
         self,
@@ -163,20 +265,23 @@ class ServerLogger:
                 except discord.Forbidden:
                     pass
             else:
-                self.webhook = webhook
+                assert webhook.token is not None
+                self.webhook = scheduled_webhook(self.bot, webhook.id, webhook.token)
                 self.has_webhook = True
+                await self.invalidate_cache()
 
         if self.has_webhook:
             try:
-                await self.webhook.send(  # type: ignore
-                    wait=True,
-                    content=content,
-                    embeds=embeds,
-                    file=file,
-                    files=files,
-                    username="Message Manager - Logs",
-                    avatar_url=self.bot.user.avatar_url,
-                )
+                with metrics.timer("webhook_send_seconds"):
+                    await self.webhook.send(  # type: ignore
+                        wait=True,
+                        content=content,
+                        embeds=embeds,
+                        file=file,
+                        files=files,
+                        username="Message Manager - Logs",
+                        avatar_url=self.bot.user.avatar_url,
+                    )
             except (discord.Forbidden, discord.NotFound):
                 await Channel.update_or_create(
                     defaults={"webhook_token": None, "webhook_id": None},
@@ -186,8 +291,13 @@ class ServerLogger:
                 self.has_webhook = False
 
                 new_webhook = await create_webhook(self.channel_id, self.bot)
+                # Published once the new webhook is saved, so others don't make one too
+                await self.invalidate_cache()
                 if not isinstance(new_webhook, errors.MissingManageWebhooks):
-                    self.webhook = new_webhook
+                    assert new_webhook.token is not None
+                    self.webhook = scheduled_webhook(
+                        self.bot, new_webhook.id, new_webhook.token
+                    )
                     self.has_webhook = True
                     await self.webhook.send(  # type: ignore
                         wait=True,
@@ -0,0 +1,428 @@
+# src/http_scheduler.py
+
+"""
+Message Manager - A bot for discord
+Copyright (C) 2020-2021 AnotherCat
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Rate limit aware scheduler for the requests the bot makes itself.
+
+Requests for interactions, component messages and log webhooks go through here
+instead of discord.py's HTTP client. Each bucket learns its limit from the
+X-RateLimit headers and requests wait for a token before they are sent, so they
+aren't sent just to be rate limited. When requests are waiting the one with the
+best priority goes first, interaction callbacks have to be answered within 3
+seconds while a log can wait.
+"""
+
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import sys
+
+from abc import ABC, abstractmethod
+from enum import IntEnum
+from typing import Any, Callable, Dict, List, Mapping, NamedTuple, Optional, Tuple
+
+import aiohttp
+import discord
+
+from discord import utils
+from discord.errors import DiscordServerError, Forbidden, HTTPException, NotFound
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = "DiscordBot (https://github.com/AnotherCat/message-manager) Python/{0[0]}.{0[1]} aiohttp/{1}".format(
+    sys.version_info, aiohttp.__version__
+)
+MAX_TRIES = 5
+PRUNE_INTERVAL = 60  # seconds
+
+
+class Priority(IntEnum):
+    # Lower goes first
+    INTERACTION = 0
+    MESSAGE = 1
+    WEBHOOK = 2
+
+
+class HTTPResponse(NamedTuple):
+    status: int
+    reason: str
+    headers: Mapping[str, str]
+    data: Any
+
+
+class HTTPBackend(ABC):
+    @abstractmethod
+    async def request(
+        self, method: str, url: str, *, headers: Dict[str, str], data: Any = None
+    ) -> HTTPResponse:
+        ...
+
+
+class AiohttpBackend(HTTPBackend):
+    def __init__(self, session: aiohttp.ClientSession) -> None:
+        self.session = session
+
+    async def request(
+        self, method: str, url: str, *, headers: Dict[str, str], data: Any = None
+    ) -> HTTPResponse:
+        async with self.session.request(method, url, headers=headers, data=data) as r:
+            # Coerce empty strings to None, like discord.py does
+            response: Any = (await r.text(encoding="utf-8")) or None
+            if r.headers.get("Content-Type") == "application/json" and response:
+                response = json.loads(response)
+            return HTTPResponse(r.status, r.reason or "", r.headers, response)
+
+
+class FakeRequest(NamedTuple):
+    method: str
+    url: str
+    headers: Dict[str, str]
+    data: Any
+    sent_at: float
+
+
+class FakeHTTPBackend(HTTPBackend):
+    """Records requests instead of sending them, for tests and benchmarks.
+
+    Responses come from ``handler`` if it is given, then from the responses
+    added with ``add_response`` in order, and otherwise are an empty 200.
+    """
+
+    def __init__(
+        self,
+        handler: Optional[Callable[[FakeRequest], HTTPResponse]] = None,
+        latency: float = 0,
+    ) -> None:
+        self.handler = handler
+        self.latency = latency
+        self.requests: List[FakeRequest] = []
+        self.responses: List[HTTPResponse] = []
+
+    def add_response(
+        self, status: int = 200, data: Any = None, headers: Mapping[str, str] = {}
+    ) -> None:
+        self.responses.append(HTTPResponse(status, "", headers, data))
+
+    async def request(
+        self, method: str, url: str, *, headers: Dict[str, str], data: Any = None
+    ) -> HTTPResponse:
+        request = FakeRequest(
+            method, url, headers, data, asyncio.get_event_loop().time()
+        )
+        self.requests.append(request)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.handler is not None:
+            return self.handler(request)
+        if len(self.responses) > 0:
+            return self.responses.pop(0)
+        return HTTPResponse(200, "OK", {}, {})
+
+
+class RateLimitBucket:
+    """A token bucket with waiters ordered by priority.
+
+    Until a response has told us the limit only one request is let through at a
+    time. A learned limit refills once at the reset the last response gave, the
+    next reset is only known from the next response. ``window`` is for limits
+    that aren't learned, like the global limit, which refill to ``limit`` every
+    ``window`` seconds by themselves.
+    """
+
+    def __init__(self, limit: Optional[int] = None, window: float = 0) -> None:
+        self.limit = limit
+        self.window = window
+        self.remaining = 1 if limit is None else limit
+        self.reset_at = 0.0
+        self.refilled = False  # Already refilled for reset_at
+        self.unlimited = False
+        self.pending = 0  # Requests waiting or in flight
+        self.bucket_hash: Optional[str] = None  # X-RateLimit-Bucket
+        self._waiters: List[Tuple[int, int, "asyncio.Future[None]"]] = []
+        self._counter = itertools.count()
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    def _refill(self, now: float) -> None:
+        if self.limit is None or self.refilled or now < self.reset_at:
+            return
+        self.remaining = self.limit
+        if self.window:
+            self.reset_at = now + self.window
+        else:
+            self.refilled = True
+
+    def idle(self, now: float) -> bool:
+        # Nothing uses it and it has nothing to wait for, so it can be dropped
+        return self.pending == 0 and (self.unlimited or now >= self.reset_at)
+
+    def _can_take(self) -> bool:
+        return self.unlimited or self.remaining > 0
+
+    def _take(self) -> None:
+        if not self.unlimited:
+            self.remaining -= 1
+
+    async def acquire(self, priority: int) -> None:
+        loop = asyncio.get_event_loop()
+        self._refill(loop.time())
+        if len(self._waiters) == 0 and self._can_take():
+            self._take()
+            return
+        future = loop.create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        self.wake()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # It was given a token just before being cancelled
+                self.remaining += 1
+                self.wake()
+            raise
+
+    def wake(self) -> None:
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        self._refill(now)
+        while len(self._waiters) > 0 and self._can_take():
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self._take()
+                future.set_result(None)
+        while len(self._waiters) > 0 and self._waiters[0][2].done():
+            heapq.heappop(self._waiters)
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+            self._wakeup = None
+        if len(self._waiters) > 0 and self.limit is not None and not self.refilled:
+            # Otherwise the response of the request in flight wakes them
+            self._wakeup = loop.call_at(max(self.reset_at, now), self.wake)
+
+    def update(self, response: HTTPResponse) -> None:
+        # Learns the limit from the rate limit headers of a response
+        headers = response.headers
+        now = asyncio.get_event_loop().time()
+        if "X-RateLimit-Limit" not in headers and response.status != 429:
+            # This route isn't rate limited, eg interaction callbacks
+            self.unlimited = True
+        else:
+            self.unlimited = False
+            if "X-RateLimit-Limit" in headers:
+                self.limit = int(headers["X-RateLimit-Limit"])
+                self.remaining = int(headers["X-RateLimit-Remaining"])
+                self.reset_at = now + float(
+                    headers.get("X-RateLimit-Reset-After", self.window or 1)
+                )
+                self.refilled = False
+                self.bucket_hash = headers.get("X-RateLimit-Bucket", self.bucket_hash)
+            if response.status == 429:
+                if self.limit is None:
+                    self.limit = 1  # So the reset refills it
+                self.remaining = 0
+                self.reset_at = now + retry_after(response)
+                self.refilled = False
+        self.wake()
+
+    def release(self) -> None:
+        # For requests that failed without a response, their token is given back
+        if self.limit is None:
+            self.remaining = max(self.remaining, 1)
+        else:
+            self.remaining = min(self.remaining + 1, self.limit)
+        self.wake()
+
+    def lock_until(self, reset_at: float) -> None:
+        self.remaining = 0
+        self.reset_at = max(self.reset_at, reset_at)
+        self.refilled = False
+        self.wake()
+
+
+def retry_after(response: HTTPResponse) -> float:
+    # The headers are always in seconds, the body's unit depends on the API version
+    for header in ("X-RateLimit-Reset-After", "Retry-After"):
+        if header in response.headers:
+            return float(response.headers[header])
+    data = response.data if isinstance(response.data, dict) else {}
+    return float(data.get("retry_after", 1))
+
+
+class HTTPScheduler:
+    def __init__(
+        self, backend: HTTPBackend, token: Optional[str], global_limit: int = 50
+    ) -> None:
+        self.backend = backend
+        self.token = token
+        self.buckets: Dict[str, RateLimitBucket] = {}
+        self.global_bucket = RateLimitBucket(limit=global_limit, window=1)
+        self.requests = 0
+        self.rate_limited = 0
+        self.pruned = 0
+        self._next_prune = 0.0
+
+    def bucket(self, key: str) -> RateLimitBucket:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            now = asyncio.get_event_loop().time()
+            if now >= self._next_prune:
+                self.prune(now)
+                self._next_prune = now + PRUNE_INTERVAL
+            bucket = self.buckets[key] = RateLimitBucket()
+        return bucket
+
+    def prune(self, now: float) -> None:
+        # Interactions have buckets of their own, which would otherwise pile up
+        idle = [key for key, bucket in self.buckets.items() if bucket.idle(now)]
+        for key in idle:
+            del self.buckets[key]
+        self.pruned += len(idle)
+
+    async def request(
+        self,
+        method: str,
+        url: str,
+        *,
+        bucket: str,
+        priority: Priority,
+        json: Optional[Any] = None,
+        form: Optional[Callable[[int], aiohttp.FormData]] = None,
+        authorize: bool = True,
+        use_global: bool = True,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> Any:
+        # form is called again for each try, files have to be re-read
+        request_headers = {"User-Agent": USER_AGENT, **(headers or {})}
+        if authorize and self.token is not None:
+            request_headers["Authorization"] = f"Bot {self.token}"
+        data: Any = None
+        if json is not None:
+            request_headers["Content-Type"] = "application/json"
+            data = utils.to_json(json)
+        rate_limit = self.bucket(bucket)
+        rate_limit.pending += 1
+        try:
+            for tries in range(MAX_TRIES):
+                if form is not None:
+                    data = form(tries)
+                await rate_limit.acquire(priority)
+                try:
+                    if use_global:
+                        await self.global_bucket.acquire(priority)
+                    self.requests += 1
+                    response = await self.backend.request(
+                        method, url, headers=request_headers, data=data
+                    )
+                except BaseException:
+                    rate_limit.release()  # Let the next waiter try
+                    raise
+                rate_limit.update(response)
+
+                if 300 > response.status >= 200:
+                    return response.data
+
+                if response.status == 429:
+                    self.rate_limited += 1
+                    delay = retry_after(response)
+                    if response.headers.get("X-RateLimit-Global"):
+                        loop = asyncio.get_event_loop()
+                        self.global_bucket.lock_until(loop.time() + delay)
+                    logger.warning(
+                        f"Rate limited on {bucket}, retrying in {delay:.2f} seconds"
+                    )
+                    continue
+
+                if response.status in (500, 502):
+                    await asyncio.sleep(1 + tries * 2)
+                    continue
+
+                message = response.data if response.data is not None else ""
+                if response.status == 403:
+                    raise Forbidden(response, message)
+                elif response.status == 404:
+                    raise NotFound(response, message)
+                raise HTTPException(response, message)
+
+            message = response.data if response.data is not None else ""
+            if response.status >= 500:
+                raise DiscordServerError(response, message)
+            raise HTTPException(response, message)
+        finally:
+            rate_limit.pending -= 1
+
+    def metrics(self) -> Dict[str, int]:
+        return {
+            "requests": self.requests,
+            "rate_limited": self.rate_limited,
+            "buckets": len(self.buckets),
+            "pruned_buckets": self.pruned,
+            "waiting": sum(bucket.waiting for bucket in self.buckets.values()),
+        }
+
+
+class ScheduledWebhookAdapter(discord.AsyncWebhookAdapter):
+    # Sends webhook requests through the scheduler, with a low priority
+
+    def __init__(
+        self, session: aiohttp.ClientSession, scheduler: HTTPScheduler
+    ) -> None:
+        super().__init__(session)
+        self.scheduler = scheduler
+
+    async def request(  # type: ignore[override]
+        self,
+        verb: str,
+        url: str,
+        payload: Optional[Dict[str, Any]] = None,
+        multipart: Optional[Dict[str, Any]] = None,
+        *,
+        files: Optional[List[discord.File]] = None,
+        reason: Optional[str] = None,
+    ) -> Any:
+        headers = {}
+        if reason:
+            headers["X-Audit-Log-Reason"] = utils._uriquote(reason, safe="/ ")  # type: ignore
+
+        def make_form(tries: int) -> aiohttp.FormData:
+            for file in files or []:
+                file.reset(seek=tries)
+            data = aiohttp.FormData()
+            for key, value in multipart.items():  # type: ignore
+                if key.startswith("file"):
+                    data.add_field(
+                        key, value[1], filename=value[0], content_type=value[2]
+                    )
+                else:
+                    data.add_field(key, value)
+            return data
+
+        return await self.scheduler.request(
+            verb,
+            url,
+            bucket=f"webhook:{self._webhook_id}",
+            priority=Priority.WEBHOOK,
+            json=payload if not multipart else None,
+            form=make_form if multipart else None,
+            authorize=False,
+            headers=headers,
+        )
@@ -1,7 +1,10 @@
 from __future__ import annotations
 
+import asyncio
+
+from abc import ABC, abstractmethod
 from enum import IntEnum
-from typing import Any, Awaitable, Dict, List, Optional, Sequence, Union
+from typing import Any, Awaitable, Dict, List, Optional, Sequence, TypeVar, Union
 from urllib.parse import quote as _uriquote
 
 from discord import Embed, Guild, Member, User
@@ -13,7 +16,9 @@ from discord.permissions import Permissions
 from discord.role import Role, RoleTags
 from discord.state import ConnectionState
 
+from src import metrics
 from src.errors import NotResponded
+from src.http_scheduler import HTTPScheduler, Priority
 
 
 class InteractionResponseFlags(IntEnum):
@@ -61,13 +66,60 @@ class ButtonStyle(IntEnum):
     Link = 5
 
 
-class PartialEmoji:
+class _Missing:
+    pass
+
+
+# Marks lazily parsed attributes and arguments that weren't passed
+MISSING: Any = _Missing()
+
+
+class FrozenComponent(ABC):
+    """Lets a component be frozen into a template.
+
+    freeze() builds the payload once, to_dict then returns that same dict and
+    the public attributes can no longer be changed. Use evolve() to get a copy
+    with a different custom_id or disabled state, the copy reuses the payload.
+    """
+
+    _payload: Optional[Dict[str, Any]] = None
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        if self._payload is not None and not name.startswith("_"):
+            raise AttributeError(
+                f"{type(self).__name__} is frozen, use evolve() to change it"
+            )
+        super().__setattr__(name, value)
+
+    @abstractmethod
+    def _build_dict(self) -> Dict[str, Any]:
+        ...
+
+    def to_dict(self) -> dict:
+        if self._payload is not None:
+            return self._payload
+        return self._build_dict()
+
+    def freeze(self: FrozenT) -> FrozenT:
+        if self._payload is None:
+            self._payload = self._build_dict()
+        return self
+
+    @property
+    def frozen(self) -> bool:
+        return self._payload is not None
+
+
+FrozenT = TypeVar("FrozenT", bound=FrozenComponent)
+
+
+class PartialEmoji(FrozenComponent):
     def __init__(self, id: Optional[int], name: str, animated: bool = False) -> None:
         self.id = id
         self.name = name
         self.animated = animated
 
-    def to_dict(self) -> dict:
+    def _build_dict(self) -> Dict[str, Any]:
         return {"id": self.id, "name": self.name, "animated": self.animated}
 
     @classmethod
@@ -78,7 +130,7 @@ class PartialEmoji:
         return cls(id=id, name=name, animated=animated)
 
 
-class Button:
+class Button(FrozenComponent):
     def __init__(
         self,
         style: ButtonStyle,
@@ -112,7 +164,20 @@ class Button:
             disabled=disabled,
         )
 
-    def to_dict(self) -> dict:
+    def evolve(self, *, custom_id: str = MISSING, disabled: bool = MISSING) -> Button:
+        payload = self.freeze().to_dict()
+        new = Button(
+            style=self.style,
+            custom_id=self.custom_id if custom_id is MISSING else custom_id,
+            emoji=self.emoji,
+            label=self.label,
+            url=self.url,
+            disabled=self.disabled if disabled is MISSING else disabled,
+        )
+        new._payload = {**payload, "custom_id": new.custom_id, "disabled": new.disabled}
+        return new
+
+    def _build_dict(self) -> Dict[str, Any]:
         d: Dict[str, Union[int, str, Dict[Any, Any]]] = {
             "type": ComponentType.Button,
             "style": self.style,
@@ -129,7 +194,7 @@ class Button:
         return d
 
 
-class SelectOption:
+class SelectOption(FrozenComponent):
     def __init__(
         self,
         label: str,
@@ -159,7 +224,7 @@ class SelectOption:
             default=default,
         )
 
-    def to_dict(self) -> dict:
+    def _build_dict(self) -> Dict[str, Any]:
         d = {"label": self.label, "value": self.value, "default": self.default}
         if self.description is not None:
             d["description"] = self.description
@@ -168,7 +233,7 @@ class SelectOption:
         return d
 
 
-class Select:
+class Select(FrozenComponent):
     def __init__(
         self,
         custom_id: str,
@@ -202,19 +267,34 @@ class Select:
             disabled=disabled,
         )
 
-    def to_dict(self) -> dict:
+    def evolve(self, *, custom_id: str = MISSING, disabled: bool = MISSING) -> Select:
+        payload = self.freeze().to_dict()
+        new = Select(
+            custom_id=self.custom_id if custom_id is MISSING else custom_id,
+            options=self.options,
+            placeholder=self.placeholder,
+            min_values=self.min_values,
+            max_values=self.max_values,
+            disabled=self.disabled if disabled is MISSING else disabled,
+        )
+        new._payload = {**payload, "custom_id": new.custom_id, "disabled": new.disabled}
+        return new
+
+    def _build_dict(self) -> Dict[str, Any]:
         d = {
             "type": ComponentType.Select,
+            "custom_id": self.custom_id,
             "options": [o.to_dict() for o in self.options],
             "min_values": self.min_values,
             "max_values": self.max_values,
+            "disabled": self.disabled,
         }
         if self.placeholder is not None:
             d["placeholder"] = self.placeholder
         return d
 
 
-class ActionRow:
+class ActionRow(FrozenComponent):
     def __init__(self, components: List[Union[Button, Select]]):
         self.components = components
 
@@ -223,7 +303,8 @@ class ActionRow:
         processed_components = [component_factory(c) for c in (data["components"])]
         return cls(components=processed_components)  # type: ignore
 
-    def to_dict(self) -> dict:
+    def _build_dict(self) -> Dict[str, Any]:
+        # Frozen components return their cached payloads
         return {
             "type": ComponentType.ActionRow,
             "components": [c.to_dict() for c in self.components],
@@ -258,6 +339,8 @@ def components_factory(
 
 
 class ComponentData:
+    __slots__ = ("custom_id", "type", "values")
+
     def __init__(self, data: Dict[Any, Any]) -> None:
         self.custom_id = data["custom_id"]
         self.type = ComponentType(int(data["component_type"]))
@@ -265,6 +348,8 @@ class ComponentData:
 
 
 class InteractionMember(Member):
+    __slots__ = ("permissions",)
+
     def __init__(
         self, data: Dict[Any, Any], state: ConnectionState, guild: Optional[Guild]
     ) -> None:
@@ -275,24 +360,67 @@ class InteractionMember(Member):
 
 
 class Interaction:
-    def __init__(self, data: Dict[str, Any], state: ConnectionState) -> None:
+    # member, user and the subclasses' payloads are only parsed when first used,
+    # most interactions only need a few fields
+    __slots__ = (
+        "_state",
+        "_scheduler",
+        "_data",
+        "_response_lock",
+        "responded",
+        "deferred",
+        "id",
+        "application_id",
+        "type",
+        "guild_id",
+        "channel_id",
+        "token",
+        "version",
+        "_member",
+        "_user",
+    )
+
+    def __init__(
+        self, data: Dict[str, Any], state: ConnectionState, scheduler: HTTPScheduler
+    ) -> None:
         self._state = state
+        self._scheduler = scheduler
+        self._data = data
+        # So a response can't be sent while the bot is deferring
+        self._response_lock = asyncio.Lock()
         self.responded = False
+        self.deferred = False
         self.id = int(data["id"])
         self.application_id = int(data["application_id"])
         self.type = InteractionType(int(data["type"]))
         self.guild_id = int(data["guild_id"]) if "guild_id" in data else None
         self.channel_id = int(data["channel_id"]) if "channel_id" in data else None
-        self.member = (
-            InteractionMember(data=data["member"], state=state, guild=self.guild)
-            if "member" in data
-            else None
-        )
-        self.user = (
-            User(data=data["user"], state=self._state) if "user" in data else None  # type: ignore
-        )
         self.token = data["token"]
         self.version = int(data["version"])
+        self._member: Optional[InteractionMember] = MISSING
+        self._user: Optional[User] = MISSING
+
+    @property
+    def member(self) -> Optional[InteractionMember]:
+        if self._member is MISSING:
+            self._member = (
+                InteractionMember(
+                    data=self._data["member"], state=self._state, guild=self.guild
+                )
+                if "member" in self._data
+                else None
+            )
+        return self._member
+
+    @property
+    def user(self) -> Optional[User]:
+        if self._user is MISSING:
+            self._user = (
+                User(data=self._data["user"], state=self._state)  # type: ignore
+                if "user" in self._data
+                else None
+            )
+        return self._user
 
     @property
     def author(self) -> Union[InteractionMember, User]:
@@ -305,6 +433,32 @@ class Interaction:
         guild = self._state._get_guild(self.guild_id)  # type: ignore
         return guild  # type: ignore
 
+    def _request(self, route: InteractionRoute, json: Any = None) -> Awaitable[Any]:
+        # Interaction endpoints don't count towards the global rate limit
+        return self._scheduler.request(
+            route.method,
+            route.url,
+            bucket=route.bucket,
+            priority=Priority.INTERACTION,
+            json=json,
+            use_global=False,
+        )
+
+    async def defer(self) -> bool:
+        # Returns False if a response was already sent
+        async with self._response_lock:
+            if self.responded:
+                return False
+            try:
+                await self._respond(
+                    response_type=InteractionResponseType.DeferredChannelMessageWithSource
+                )
+            except asyncio.CancelledError:
+                self.deferred = True  # It may have been sent already
+                raise
+            self.deferred = True
+            return True
+
     async def respond(
         self,
         *,
@@ -313,6 +467,47 @@ class Interaction:
         embeds: Optional[List[Embed]] = None,
         flags: Optional[InteractionResponseFlags] = None,
         components: Optional[Sequence[Union[ActionRow, Button, Select]]] = None,
+    ) -> None:
+        async with self._response_lock:
+            if not self.deferred:
+                await self._respond(
+                    response_type=response_type,
+                    content=content,
+                    embeds=embeds,
+                    flags=flags,
+                    components=components,
+                )
+            elif response_type in (
+                InteractionResponseType.ChannelMessageWithSource,
+                InteractionResponseType.UpdateMessage,
+            ):
+                # The bot deferred, so the response replaces the loading message
+                if flags is not None and flags & InteractionResponseFlags.EPHEMERAL:
+                    # The loading message is public, it can't become ephemeral
+                    await self.delete_response()
+                    await self.create_followup(
+                        content=content,
+                        embeds=embeds,
+                        flags=flags,
+                        components=components,
+                    )
+                else:
+                    await self.edit_response(
+                        content=content, embeds=embeds, components=components
+                    )
+            else:
+                raise ValueError(
+                    f"{response_type.name} can't be sent after the interaction was deferred"
+                )
+
+    async def _respond(
+        self,
+        *,
+        response_type: InteractionResponseType,
+        content: Optional[str] = None,
+        embeds: Optional[List[Embed]] = None,
+        flags: Optional[InteractionResponseFlags] = None,
+        components: Optional[Sequence[Union[ActionRow, Button, Select]]] = None,
     ) -> None:
         route = InteractionRoute(
             method="POST",
@@ -334,7 +529,8 @@ class Interaction:
             },
         }
         self.responded = True
-        await self._state.http.request(route=route, json=json)  # type: ignore
+        with metrics.timer("interaction_callback_seconds"):
+            await self._request(route, json=json)
 
     def edit_response(
         self,
@@ -373,7 +569,7 @@ class Interaction:
         )
         data = {"embeds": embeds, "content": content, "components": components}
 
-        response = await self._state.http.request(route=route, json=data)  # type: ignore
+        response = await self._request(route, json=data)
         return response  # type: ignore
 
     async def create_followup(
@@ -400,7 +596,7 @@ class Interaction:
             application_id=self.application_id,
             webhook_token=self.token,
         )
-        return await self._state.http.request(route=route, json=data)  # type: ignore
+        return await self._request(route, json=data)  # type: ignore
 
     async def delete_followup(self, message_id: Union[str, int]) -> None:
         route = InteractionRoute(
@@ -410,30 +606,63 @@ class Interaction:
             webhook_token=self.token,
             message_id=message_id,
         )
-        await self._state.http.request(route=route)  # type: ignore
+        await self._request(route)
 
     def delete_response(self) -> Awaitable:
         return self.delete_followup(message_id="@original")
 
 
 class CommandInteraction(Interaction):
-    def __init__(self, data: Dict[str, Any], state: ConnectionState) -> None:
-        super().__init__(data=data, state=state)
-        self.data = ApplicationCommandInteractionData(
-            data=data["data"], state=self._state, guild=self.guild
-        )
+    __slots__ = ("_command_data",)
+
+    def __init__(
+        self, data: Dict[str, Any], state: ConnectionState, scheduler: HTTPScheduler
+    ) -> None:
+        super().__init__(data=data, state=state, scheduler=scheduler)
+        self._command_data: ApplicationCommandInteractionData = MISSING
+
+    @property
+    def data(self) -> ApplicationCommandInteractionData:
+        if self._command_data is MISSING:
+            self._command_data = ApplicationCommandInteractionData(
+                data=self._data["data"], state=self._state, guild=self.guild
+            )
+        return self._command_data
 
 
 class ComponentInteraction(Interaction):
-    def __init__(self, data: Dict[str, Any], state: ConnectionState) -> None:
-        super().__init__(data=data, state=state)
-        self.message = ComponentMessage(
-            data["message"]
-        )  # I seriously can't be bothered to make a message class for components
-        self.component = ComponentData(data["data"])
+    __slots__ = ("_message", "component")
+
+    def __init__(
+        self, data: Dict[str, Any], state: ConnectionState, scheduler: HTTPScheduler
+    ) -> None:
+        super().__init__(data=data, state=state, scheduler=scheduler)
+        self._message: ComponentMessage = MISSING
+        self.component = ComponentData(data["data"])  # Needed to find the listener
+
+    @property
+    def message(self) -> ComponentMessage:
+        if self._message is MISSING:
+            # I seriously can't be bothered to make a message class for components
+            self._message = ComponentMessage(self._data["message"])
+        return self._message
+
+
+def interaction_factory(
+    data: Dict[str, Any], state: ConnectionState, scheduler: HTTPScheduler
+) -> Optional[Union[CommandInteraction, ComponentInteraction]]:
+    # Only the final class is built, None for types the bot doesn't handle
+    interaction_type = int(data["type"])
+    if interaction_type == InteractionType.APPLICATION_COMMAND:
+        return CommandInteraction(data=data, state=state, scheduler=scheduler)
+    elif interaction_type == InteractionType.MESSAGE_COMPONENT:
+        return ComponentInteraction(data=data, state=state, scheduler=scheduler)
+    return None
 
 
 class ComponentMessage:
+    __slots__ = ("id", "flags", "content", "embeds", "components")
+
     def __init__(self, data: Dict[Any, Any]) -> None:
         # Major data loss, but I don't need that data.
         self.id = int(data["id"])
@@ -466,35 +695,39 @@ class InteractionRoute(Route):
         self.url: str = url
 
         # major parameters:
-        self.channel_id = parameters.get("channel_id")
-        self.guild_id = parameters.get("guild_id")
-        self.webhook_id = parameters.get("webhook_id")
+        self.application_id = parameters.get("application_id")
         self.webhook_token = parameters.get("webhook_token")
         self.interaction_id = parameters.get("interaction_id")
 
     @property
     def bucket(self) -> str:
-        # the bucket is just method + path w/ major parameters
-        return f"{self.channel_id}:{self.guild_id}:{self.webhook_id}:{self.webhook_token}:{self.path}"
+        # Limits are per interaction token, the scheduler learns the rest from headers
+        return f"{self.method}:{self.path}:{self.interaction_id}:{self.webhook_token}"
 
 
 class ApplicationCommandInteractionData:
+    __slots__ = (
+        "_raw_options",
+        "_options",
+        "_state",
+        "_guild",
+        "id",
+        "name",
+        "resolved",
+        "custom_id",
+        "component_type",
+    )
+
     def __init__(
         self, data: Dict[str, Any], state: ConnectionState, guild: Optional[Guild]
     ) -> None:
+        self._state = state
+        self._guild = guild
         self.id = int(data["id"])
         self.name = data["name"]
         self.resolved = data["resolved"] if "resolved" in data else None
-        self.options = (
-            [
-                ApplicationCommandInteractionDataOption(
-                    data=d, resolved=self.resolved, state=state, guild=guild
-                )
-                for d in data["options"]
-            ]
-            if "options" in data
-            else None
-        )
+        self._raw_options: Optional[List[Dict[str, Any]]] = data.get("options")
+        self._options: Optional[List[ApplicationCommandInteractionDataOption]] = MISSING
         self.custom_id = data["custom_id"] if "custom_id" in data else None
         self.component_type = (
             ComponentType(int(data["component_type"]))
@@ -502,8 +735,38 @@ class ApplicationCommandInteractionData:
             else None
         )
 
+    @property
+    def options(self) -> Optional[List[ApplicationCommandInteractionDataOption]]:
+        if self._options is MISSING:
+            self._options = (
+                [
+                    ApplicationCommandInteractionDataOption(
+                        data=d,
+                        resolved=self.resolved,
+                        state=self._state,
+                        guild=self._guild,
+                    )
+                    for d in self._raw_options
+                ]
+                if self._raw_options is not None
+                else None
+            )
+        return self._options
+
 
 class ApplicationCommandInteractionDataOption:
+    __slots__ = (
+        "_raw_options",
+        "_options",
+        "_resolved",
+        "_state",
+        "_guild",
+        "name",
+        "type",
+        "raw_value",
+        "value",
+    )
+
     def __init__(
         self,
         data: Dict[str, Any],
@@ -514,9 +777,12 @@ class ApplicationCommandInteractionDataOption:
         self.name = data["name"]
         self.type = ApplicationCommandOptionType(int(data["type"]))
         self._resolved = resolved
+        self._state = state
+        self._guild = guild
+        self._raw_options: Optional[List[Dict[str, Any]]] = None
+        self._options: Optional[List[ApplicationCommandInteractionDataOption]] = MISSING
         if "value" in data:
             self.raw_value = data["value"]
-            self.options = None
             if self.type == ApplicationCommandOptionType.CHANNEL:
                 if (
                     "channels" not in resolved
@@ -555,17 +821,43 @@ class ApplicationCommandInteractionDataOption:
 
         elif "options" in data:
             self.value = self.raw_value = None
-            self.options = [
-                ApplicationCommandInteractionDataOption(
-                    data=d, resolved=self._resolved, state=state, guild=guild
-                )
-                for d in data["options"]
-            ]
+            self._raw_options = data["options"]
         else:
-            self.value = self.raw_value = self.options = None
+            self.value = self.raw_value = None
+
+    @property
+    def options(self) -> Optional[List[ApplicationCommandInteractionDataOption]]:
+        # Sub commands and groups, parsed when first used
+        if self._options is MISSING:
+            self._options = (
+                [
+                    ApplicationCommandInteractionDataOption(
+                        data=d,
+                        resolved=self._resolved,
+                        state=self._state,
+                        guild=self._guild,
+                    )
+                    for d in self._raw_options
+                ]
+                if self._raw_options is not None
+                else None
+            )
+        return self._options
 
 
 class PartialRole:
+    __slots__ = (
+        "id",
+        "name",
+        "permissions",
+        "position",
+        "colour",
+        "hoist",
+        "managed",
+        "mentionable",
+        "tags",
+    )
+
     def __init__(self, data: Dict[str, Any]) -> None:
         self.id = int(data["id"])
         self.name = data["name"]
@@ -584,6 +876,8 @@ class PartialRole:
 
 
 class PartialChannel:
+    __slots__ = ("name", "id", "type", "permissions")
+
     def __init__(self, data: Dict[str, Any]) -> None:
         self.name = data["name"]
         self.id = int(data["id"])
@@ -595,6 +889,7 @@ async def send_message_components(
     *,
     content: Optional[str] = None,
     state: ConnectionState,
+    scheduler: HTTPScheduler,
     channel_id: int,
     embed: Optional[Embed] = None,
     components: Optional[Sequence[Union[ActionRow, Button, Select]]] = None,
@@ -618,7 +913,13 @@ async def send_message_components(
     if components:
         payload["components"] = components
 
-    response = await state.http.request(r, json=payload)
+    response = await scheduler.request(
+        r.method,
+        r.url,
+        bucket=f"{r.method}:{r.bucket}",
+        priority=Priority.MESSAGE,
+        json=payload,
+    )
     message_id = int(response["id"])
 
     return message_id
@@ -628,6 +929,7 @@ async def edit_message_components(
     *,
     content: Optional[str] = None,
     state: ConnectionState,
+    scheduler: HTTPScheduler,
     channel_id: int,
     message_id: int,
     embed: Optional[Embed] = None,
@@ -657,7 +959,13 @@ async def edit_message_components(
     if components:
         payload["components"] = components
 
-    response = await state.http.request(r, json=payload)
+    response = await scheduler.request(
+        r.method,
+        r.url,
+        bucket=f"{r.method}:{r.bucket}",
+        priority=Priority.MESSAGE,
+        json=payload,
+    )
     message_id = int(response["id"])
 
     return message_id
@@ -0,0 +1,180 @@
+# src/invalidation.py
+
+"""
+Message Manager - A bot for discord
+Copyright (C) 2020-2021 AnotherCat
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import json
+import logging
+import uuid
+
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+Subscriber = Callable[[Hashable], None]
+Clearer = Callable[[], None]
+
+
+class InvalidationBus(ABC):
+    """Tells every process that a cache key is stale.
+
+    Caches subscribe to a topic (eg "guild") with a callback that drops the key,
+    publishing runs the callbacks of every subscriber in every process. ``clear``
+    empties the whole cache, for when invalidations may have been missed.
+    """
+
+    def __init__(self) -> None:
+        self.subscribers: Dict[str, List[Subscriber]] = {}
+        self.clearers: List[Clearer] = []
+        self.published = 0
+        self.received = 0
+
+    def subscribe(
+        self, topic: str, callback: Subscriber, clear: Optional[Clearer] = None
+    ) -> None:
+        self.subscribers.setdefault(topic, []).append(callback)
+        if clear is not None:
+            self.clearers.append(clear)
+
+    def clear_all(self) -> None:
+        for clear in self.clearers:
+            try:
+                clear()
+            except Exception:
+                logger.error("Failed to clear a cache", exc_info=True)
+
+    def deliver(self, topic: str, key: Hashable) -> None:
+        for callback in self.subscribers.get(topic, []):
+            try:
+                callback(key)
+            except Exception:
+                logger.error(f"Failed to invalidate {topic} {key}", exc_info=True)
+
+    @abstractmethod
+    async def publish(self, topic: str, key: Hashable) -> None:
+        ...
+
+    def metrics(self) -> Dict[str, int]:
+        return {"published": self.published, "received": self.received}
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+
+class LocalInvalidationBus(InvalidationBus):
+    # Only this process, for a single process bot and for tests
+
+    async def publish(self, topic: str, key: Hashable) -> None:
+        self.published += 1
+        self.deliver(topic, key)
+
+
+class PostgresInvalidationBus(InvalidationBus):
+    """Sends invalidations to the other processes with Postgres LISTEN/NOTIFY.
+
+    Keys must be json serialisable, lists are turned back into tuples. Each
+    process has an origin id so it skips its own notifications, the key was
+    already invalidated locally when it was published.
+    """
+
+    channel = "message_manager_invalidation"
+
+    def __init__(self, dsn: str) -> None:
+        super().__init__()
+        self.dsn = dsn
+        self.origin = uuid.uuid4().hex
+        self.connection: Optional[asyncpg.Connection] = None
+        self._closing = False
+        # The connection also listens, and can only run one query at a time
+        self._send_lock = asyncio.Lock()
+
+    async def start(self) -> None:
+        self.connection = await asyncpg.connect(self.dsn)
+        await self.connection.add_listener(self.channel, self._on_notification)
+        self.connection.add_termination_listener(self._on_termination)
+
+    async def _reconnect(self) -> None:
+        delay = 1.0
+        while not self._closing and self.connection is None:
+            await asyncio.sleep(delay)
+            try:
+                await self.start()
+            except (OSError, asyncpg.PostgresError):
+                logger.warning("Failed to reconnect for cache invalidation")
+                delay = min(delay * 2, 60)
+            else:
+                # Anything cached may have missed invalidations while disconnected
+                self.clear_all()
+                logger.info("Reconnected for cache invalidation, caches cleared")
+
+    async def close(self) -> None:
+        self._closing = True
+        if self.connection is not None:
+            connection, self.connection = self.connection, None
+            await connection.close()
+
+    async def publish(self, topic: str, key: Hashable) -> None:
+        self.published += 1
+        self.deliver(topic, key)
+        payload = json.dumps({"origin": self.origin, "topic": topic, "key": key})
+        # The change is already saved, so failing to send it isn't the command's error
+        async with self._send_lock:
+            if self.connection is None:
+                logger.warning(f"Invalidation of {topic} {key} not sent, not connected")
+                return
+            try:
+                await self.connection.execute(
+                    "SELECT pg_notify($1, $2)", self.channel, payload
+                )
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError):
+                logger.warning(
+                    f"Failed to send the invalidation of {topic} {key}", exc_info=True
+                )
+
+    def _on_notification(
+        self, connection: asyncpg.Connection, pid: int, channel: str, payload: str
+    ) -> None:
+        data: Dict[str, Any] = json.loads(payload)
+        if data["origin"] == self.origin:
+            return
+        self.received += 1
+        key = data["key"]
+        self.deliver(data["topic"], tuple(key) if isinstance(key, list) else key)
+
+    def _on_termination(self, connection: asyncpg.Connection) -> None:
+        if self.connection is connection:
+            # Invalidations sent until it reconnects are missed
+            logger.error("Lost the cache invalidation connection")
+            self.connection = None
+            if not self._closing:
+                asyncio.ensure_future(self._reconnect())
+
+
+def create_invalidation_bus(backend: str, dsn: str) -> InvalidationBus:
+    if backend == "postgres":
+        return PostgresInvalidationBus(dsn)
+    elif backend == "local":
+        return LocalInvalidationBus()
+    raise ValueError(f"Unknown cache invalidation backend {backend}")
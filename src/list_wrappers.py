@@ -18,88 +18,154 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-from typing import Dict, Union
+import asyncio
+import logging
+import time
+
+from abc import ABC, abstractmethod
+from typing import Dict, Optional, Union
+
+import aiohttp
 
 from main import Bot
 
+logger = logging.getLogger(__name__)
+
+REQUEST_TIMEOUT = 10  # Seconds for each try, so a slow site can't hold up the others
+MAX_TRIES = 3
+MAX_RETRY_AFTER = 60  # Longer waits are left for the next post
+
 
-class HttpClient:
-    def __init__(self, bot: Bot, token: str) -> None:
+class HttpClient(ABC):
+    def __init__(self, bot: Bot, token: str, session: aiohttp.ClientSession) -> None:
         self.token = token
         self.base_url: str
         self.bot = bot
+        self.session = session
+        self.name = type(self).__name__
+        # From the last post
+        self.status: Optional[int] = None
+        self.latency: Optional[float] = None
+        self.error: Optional[str] = None
+        self.posts = 0
+        self.failures = 0
 
     async def _request(
         self, method: str, url: str, json: Dict[str, Union[str, int]]
     ) -> int:
         url = f"{self.base_url}{url}"
         headers = {"Authorization": self.token, "Content-Type": "application/json"}
-        async with self.bot.session.request(
-            method=method, url=url, headers=headers, json=json
-        ) as r:
-            return r.status
+        timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+        delay = 0.0
+        for tries in range(MAX_TRIES):
+            if tries > 0:
+                await asyncio.sleep(delay)
+            delay = 2 ** (tries + 1)
+            try:
+                async with self.session.request(
+                    method=method, url=url, headers=headers, json=json, timeout=timeout
+                ) as r:
+                    status = r.status
+                    retry_after = r.headers.get("Retry-After")
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if tries == MAX_TRIES - 1:
+                    raise
+                continue
+            if status != 429 and status < 500:
+                break
+            if status == 429 and retry_after is not None:
+                try:
+                    delay = float(retry_after)
+                except ValueError:
+                    pass  # A date, the backoff is used instead
+                if delay > MAX_RETRY_AFTER:
+                    break
+        return status
+
+    @abstractmethod
+    async def post_guild_stats(self, guild_count: int) -> int:
+        ...
+
+    async def post(self, guild_count: int) -> None:
+        # Never raises, so that one site failing doesn't stop the others
+        start = time.perf_counter()
+        self.posts += 1
+        try:
+            self.status = await self.post_guild_stats(guild_count)
+            self.error = None if self.status < 300 else f"HTTP {self.status}"
+        except Exception as e:
+            self.status = None
+            self.error = repr(e)
+        self.latency = time.perf_counter() - start
+        if self.error is not None:
+            self.failures += 1
+            logger.warning(f"Failed to post stats to {self.name}: {self.error}")
+
+    def metrics(self) -> Dict[str, Union[None, str, int, float]]:
+        return {
+            "status": self.status,
+            "latency": self.latency,
+            "error": self.error,
+            "posts": self.posts,
+            "failures": self.failures,
+        }
 
 
 class TopGG(HttpClient):
-    def __init__(self, bot: Bot, token: str) -> None:
+    def __init__(self, bot: Bot, token: str, session: aiohttp.ClientSession) -> None:
         self.base_url = "https://top.gg/api/"
         self.bot = bot
-        super().__init__(bot, token)
+        super().__init__(bot, token, session)
 
-    async def post_guild_stats(self) -> None:
+    async def post_guild_stats(self, guild_count: int) -> int:
         url = f"bots/{self.bot.user.id}/stats"
-        guild_count = len(self.bot.guilds)
         payload: Dict[str, Union[str, int]] = {"server_count": guild_count}
-        await self._request(url=url, method="POST", json=payload)
+        return await self._request(url=url, method="POST", json=payload)
 
 
 class Del(HttpClient):
-    def __init__(self, bot: Bot, token: str) -> None:
+    def __init__(self, bot: Bot, token: str, session: aiohttp.ClientSession) -> None:
         self.base_url = "https://api.discordextremelist.xyz/v2/"
         self.bot = bot
-        super().__init__(bot, token)
+        super().__init__(bot, token, session)
 
-    async def post_guild_stats(self) -> None:
+    async def post_guild_stats(self, guild_count: int) -> int:
         url = f"bot/{self.bot.user.id}/stats"
-        guild_count = len(self.bot.guilds)
         payload: Dict[str, Union[str, int]] = {"guildCount": guild_count}
-        await self._request(url=url, method="POST", json=payload)
+        return await self._request(url=url, method="POST", json=payload)
 
 
 class Dbl(HttpClient):
-    def __init__(self, bot: Bot, token: str) -> None:
+    def __init__(self, bot: Bot, token: str, session: aiohttp.ClientSession) -> None:
         self.base_url = "https://discordbotlist.com/api/v1/"
         self.bot = bot
-        super().__init__(bot, token)
+        super().__init__(bot, token, session)
 
-    async def post_guild_stats(self) -> None:
+    async def post_guild_stats(self, guild_count: int) -> int:
         url = f"/bots/{self.bot.user.id}/stats"
-        guild_count = len(self.bot.guilds)
         payload: Dict[str, Union[str, int]] = {"guilds": guild_count}
-        await self._request(url=url, method="POST", json=payload)
+        return await self._request(url=url, method="POST", json=payload)
 
 
 class DBoats(HttpClient):
-    def __init__(self, bot: Bot, token: str) -> None:
+    def __init__(self, bot: Bot, token: str, session: aiohttp.ClientSession) -> None:
         self.base_url = "https://discord.boats/api/"
         self.bot = bot
-        super().__init__(bot, token)
+        super().__init__(bot, token, session)
 
-    async def post_guild_stats(self) -> None:
+    async def post_guild_stats(self, guild_count: int) -> int:
         url = f"bot/{self.bot.user.id}"
-        guild_count = len(self.bot.guilds)
         payload: Dict[str, Union[str, int]] = {"server_count": guild_count}
-        await self._request(url=url, method="POST", json=payload)
+        return await self._request(url=url, method="POST", json=payload)
 
 
 class Dbgg(HttpClient):
-    def __init__(self, bot: Bot, token: str) -> None:
+    def __init__(self, bot: Bot, token: str, session: aiohttp.ClientSession) -> None:
         self.base_url = "https://discord.bots.gg/api/v1/"
         self.bot = bot
-        super().__init__(bot, token)
+        super().__init__(bot, token, session)
 
-    async def post_guild_stats(self) -> None:
+    async def post_guild_stats(self, guild_count: int) -> int:
         url = f"bots/{self.bot.user.id}/stats"
-        guild_count = len(self.bot.guilds)
         payload: Dict[str, Union[str, int]] = {"guildCount": guild_count}
-        await self._request(url=url, method="POST", json=payload)
+        return await self._request(url=url, method="POST", json=payload)
@@ -0,0 +1,243 @@
+# src/metrics.py
+
+"""
+Message Manager - A bot for discord
+Copyright (C) 2020-2021 AnotherCat
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Timings for the hot paths, kept as histograms.
+
+Timers are only a ``perf_counter`` call either side and a bisect, and when
+METRICS_ENABLED is off ``timer`` returns a shared timer that does nothing.
+Counters that other parts of the bot already keep are read by collectors when
+the metrics are shown, so they cost nothing until then.
+"""
+
+import logging
+import time
+
+from bisect import bisect_left
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple, Union
+
+from aiohttp import web
+
+import load_config
+
+logger = logging.getLogger(__name__)
+
+# Seconds
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+NAMESPACE = "message_manager"
+
+Labels = Tuple[Tuple[str, str], ...]
+Collector = Callable[[], Mapping[str, Any]]
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # The upper bound of the bucket the quantile falls in
+        target = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target and count > 0:
+                return (
+                    self.buckets[index] if index < len(self.buckets) else float("inf")
+                )
+        return 0.0
+
+
+class Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram: Histogram) -> None:
+        self.histogram = histogram
+        self.start = 0.0
+
+    def __enter__(self) -> "Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class NullTimer:
+    __slots__ = ()
+
+    def __enter__(self) -> "NullTimer":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = labels + (extra,) if extra is not None else labels
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+class MetricsRegistry:
+    def __init__(self, enabled: bool) -> None:
+        self.enabled = enabled
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.collectors: Dict[str, Collector] = {}
+
+    def histogram(self, name: str, **labels: str) -> Histogram:
+        by_labels = self.histograms.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        histogram = by_labels.get(key)
+        if histogram is None:
+            histogram = by_labels[key] = Histogram()
+        return histogram
+
+    def timer(self, name: str, **labels: str) -> Union[Timer, NullTimer]:
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self.histogram(name, **labels))
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        if self.enabled:
+            self.histogram(name, **labels).observe(value)
+
+    def add_collector(self, name: str, collector: Collector) -> None:
+        self.collectors[name] = collector
+
+    def remove_collector(self, name: str) -> None:
+        self.collectors.pop(name, None)
+
+    def collect(self) -> Dict[str, float]:
+        # Only numbers are kept, collectors may return other details too
+        values: Dict[str, float] = {}
+        for name, collector in self.collectors.items():
+            try:
+                collected = collector()
+            except Exception:
+                logger.error(f"Failed to collect {name} metrics", exc_info=True)
+                continue
+            for key, value in collected.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    values[f"{name}_{key}"] = value
+        return values
+
+    def summary(self) -> List[str]:
+        lines = []
+        for name, by_labels in sorted(self.histograms.items()):
+            for labels, histogram in sorted(by_labels.items()):
+                if histogram.count == 0:
+                    continue
+                lines.append(
+                    f"{name}{_format_labels(labels)}: n={histogram.count} "
+                    f"avg={histogram.sum / histogram.count * 1000:.2f}ms "
+                    f"p50<={histogram.quantile(0.5) * 1000:g}ms "
+                    f"p95<={histogram.quantile(0.95) * 1000:g}ms "
+                    f"p99<={histogram.quantile(0.99) * 1000:g}ms"
+                )
+        for key, value in sorted(self.collect().items()):
+            lines.append(f"{key}: {value:g}")
+        return lines
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for name, by_labels in sorted(self.histograms.items()):
+            full_name = f"{NAMESPACE}_{name}"
+            lines.append(f"# TYPE {full_name} histogram")
+            for labels, histogram in sorted(by_labels.items()):
+                cumulative = 0
+                for bound, count in zip(
+                    histogram.buckets + (float("inf"),), histogram.counts
+                ):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    lines.append(
+                        f"{full_name}_bucket{_format_labels(labels, ('le', le))} {cumulative}"
+                    )
+                lines.append(f"{full_name}_sum{_format_labels(labels)} {histogram.sum}")
+                lines.append(
+                    f"{full_name}_count{_format_labels(labels)} {histogram.count}"
+                )
+        for key, value in sorted(self.collect().items()):
+            lines.append(f"# TYPE {NAMESPACE}_{key} gauge")
+            lines.append(f"{NAMESPACE}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    # Serves /metrics in the Prometheus text format, only on localhost
+
+    def __init__(self, registry: MetricsRegistry, port: int) -> None:
+        self.registry = registry
+        self.port = port
+        self.runner: Optional[web.AppRunner] = None
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(
+            text=self.registry.render_prometheus(),
+            content_type="text/plain",
+            headers={"X-Content-Type-Options": "nosniff"},
+        )
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle_metrics)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", self.port).start()
+        logger.info(f"Serving metrics on 127.0.0.1:{self.port}")
+
+    async def close(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+registry = MetricsRegistry(enabled=load_config.metrics_enabled)
+timer = registry.timer
+observe = registry.observe
@@ -1,7 +1,9 @@
 from enum import IntEnum
-from typing import Optional, Union
+from typing import Any, List, NamedTuple, Optional, Sequence, Union
 
-from tortoise import Model, fields
+from tortoise import Model, Tortoise, fields
+from tortoise.backends.asyncpg.client import AsyncpgDBClient
+from tortoise.exceptions import DoesNotExist, IntegrityError
 from tortoise.fields.data import (
     BigIntField,
     BooleanField,
@@ -92,3 +94,175 @@ class CommandUsageAnalytics(Model):
 
     def __str__(self) -> str:
         return str(f"{self.guild_id}-{self.timestamp}-{self.command_name}")
+
+
+# The lookups below run for nearly every event. On postgres they are sent as
+# fixed SQL, which asyncpg prepares once per connection and keeps in its
+# statement cache, instead of Tortoise building the query and models each call.
+# Other backends (eg SQLite in the benchmarks) use the ORM.
+
+
+class GuildRow(NamedTuple):
+    id: int
+    management_role_id: Optional[int]
+    prefix: str
+
+
+class LoggingChannelRow(NamedTuple):
+    channel_id: int
+    webhook_id: Optional[int]
+    webhook_token: Optional[str]
+
+
+class ChannelWebhookRow(NamedTuple):
+    webhook_id: Optional[int]
+    webhook_token: Optional[str]
+
+
+SELECT_GUILDS = (
+    "SELECT id, management_role_id, prefix FROM guilds WHERE id = ANY($1::bigint[])"
+)
+# Only returns the guilds it made, ones made by another process since they were
+# looked for are skipped without being written or locked
+INSERT_GUILDS = (
+    "INSERT INTO guilds (id, management_role_id, prefix) "
+    "SELECT id, NULL, $2 FROM unnest($1::bigint[]) AS id "
+    "ON CONFLICT (id) DO NOTHING "
+    "RETURNING id, management_role_id, prefix"
+)
+UPDATE_GUILD = {
+    field: f"UPDATE guilds SET {field} = $2 WHERE id = $1 "
+    "RETURNING id, management_role_id, prefix"
+    for field in ("management_role_id", "prefix")
+}
+SELECT_LOGGING_CHANNEL = (
+    "SELECT lc.channel_id, c.webhook_id, c.webhook_token FROM logging_channels lc "
+    "JOIN channels c ON c.id = lc.channel_id "
+    "WHERE lc.guild_id = $1 AND lc.logger_type = $2 LIMIT 1"
+)
+SELECT_CHANNEL_WEBHOOK = "SELECT webhook_id, webhook_token FROM channels WHERE id = $1"
+
+
+def asyncpg_client() -> Optional[AsyncpgDBClient]:
+    connection = Tortoise.get_connection("default")
+    return connection if isinstance(connection, AsyncpgDBClient) else None
+
+
+async def fetch_guild_rows(ids: Sequence[int]) -> List[GuildRow]:
+    client = asyncpg_client()
+    if client is None:
+        return await fetch_guild_rows_orm(ids)
+    async with client.acquire_connection() as connection:
+        rows = await connection.fetch(SELECT_GUILDS, list(ids))
+    return [GuildRow(*row) for row in rows]
+
+
+async def fetch_guild_rows_orm(ids: Sequence[int]) -> List[GuildRow]:
+    rows = await Guild.filter(id__in=ids).values_list(
+        "id", "management_role_id", "prefix"
+    )
+    return [GuildRow(*row) for row in rows]
+
+
+async def create_guild_rows(ids: Sequence[int], default_prefix: str) -> List[GuildRow]:
+    # For guilds that weren't found, returns the rows of all of them
+    client = asyncpg_client()
+    if client is None:
+        return await create_guild_rows_orm(ids, default_prefix)
+    unique_ids = list(dict.fromkeys(ids))
+    async with client.acquire_connection() as connection:
+        rows = await connection.fetch(INSERT_GUILDS, unique_ids, default_prefix)
+        if len(rows) < len(unique_ids):
+            # Made by another process in the meantime
+            created = {row[0] for row in rows}
+            rows += await connection.fetch(
+                SELECT_GUILDS, [key for key in unique_ids if key not in created]
+            )
+    return [GuildRow(*row) for row in rows]
+
+
+async def create_guild_rows_orm(
+    ids: Sequence[int], default_prefix: str
+) -> List[GuildRow]:
+    try:
+        await Guild.bulk_create(
+            [
+                Guild(id=guild_id, management_role_id=None, prefix=default_prefix)
+                for guild_id in dict.fromkeys(ids)
+            ]
+        )
+    except IntegrityError:
+        # Some were created since they were looked for, fall back to one at a time
+        rows = []
+        for guild_id in dict.fromkeys(ids):
+            guild, _ = await Guild.get_or_create(
+                defaults={"management_role_id": None, "prefix": default_prefix},
+                id=guild_id,
+            )
+            rows.append(GuildRow(guild.id, guild.management_role_id, guild.prefix))
+        return rows
+    return [GuildRow(guild_id, None, default_prefix) for guild_id in dict.fromkeys(ids)]
+
+
+async def update_guild_row(guild_id: int, field: str, value: Any) -> GuildRow:
+    # Raises DoesNotExist if there is no guild with that id
+    client = asyncpg_client()
+    if client is None:
+        return await update_guild_row_orm(guild_id, field, value)
+    async with client.acquire_connection() as connection:
+        row = await connection.fetchrow(UPDATE_GUILD[field], guild_id, value)
+    if row is None:
+        raise DoesNotExist("Object does not exist")
+    return GuildRow(*row)
+
+
+async def update_guild_row_orm(guild_id: int, field: str, value: Any) -> GuildRow:
+    guild = await Guild.get(id=guild_id)
+    setattr(guild, field, value)
+    await guild.save(update_fields=[field])
+    return GuildRow(guild.id, guild.management_role_id, guild.prefix)
+
+
+async def fetch_logging_channel_row(
+    guild_id: int, logger_type: str
+) -> Optional[LoggingChannelRow]:
+    client = asyncpg_client()
+    if client is None:
+        return await fetch_logging_channel_row_orm(guild_id, logger_type)
+    async with client.acquire_connection() as connection:
+        row = await connection.fetchrow(SELECT_LOGGING_CHANNEL, guild_id, logger_type)
+    return LoggingChannelRow(*row) if row is not None else None
+
+
+async def fetch_logging_channel_row_orm(
+    guild_id: int, logger_type: str
+) -> Optional[LoggingChannelRow]:
+    logger: Optional[LoggingChannel] = (
+        await LoggingChannel.filter(guild_id=guild_id, logger_type=logger_type)
+        .first()
+        .prefetch_related("channel")
+    )
+    if logger is None:
+        return None
+    assert isinstance(logger.channel, Channel)
+    return LoggingChannelRow(
+        logger.channel_id, logger.channel.webhook_id, logger.channel.webhook_token
+    )
+
+
+async def fetch_channel_webhook_row(channel_id: int) -> Optional[ChannelWebhookRow]:
+    client = asyncpg_client()
+    if client is None:
+        return await fetch_channel_webhook_row_orm(channel_id)
+    async with client.acquire_connection() as connection:
+        row = await connection.fetchrow(SELECT_CHANNEL_WEBHOOK, channel_id)
+    return ChannelWebhookRow(*row) if row is not None else None
+
+
+async def fetch_channel_webhook_row_orm(
+    channel_id: int,
+) -> Optional[ChannelWebhookRow]:
+    rows = await Channel.filter(id=channel_id).values_list(
+        "webhook_id", "webhook_token"
+    )
+    return ChannelWebhookRow(*rows[0]) if len(rows) > 0 else None
@@ -0,0 +1,32 @@
+# tests/conftest.py
+
+"""
+Message Manager - A bot for discord
+Copyright (C) 2020-2021 AnotherCat
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+
+# Before anything imports load_config
+for name, value in (
+    ("DISCORD_TOKEN", "test"),
+    ("POSTGRES_USER", "test"),
+    ("POSTGRES_PASSWORD", "test"),
+    ("POSTGRES_DB", "test"),
+    ("BOT_OWNERS", "1"),
+    ("BOT_SELFHOST", "True"),
+):
+    os.environ.setdefault(name, value)
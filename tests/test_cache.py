@@ -0,0 +1,79 @@
+# tests/test_cache.py
+
+"""
+Message Manager - A bot for discord
+Copyright (C) 2020-2021 AnotherCat
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+
+from typing import Hashable, List
+
+from src.cache import BaseLFUCache
+
+
+class SlowCache(BaseLFUCache):
+    # Each fetch waits for release and returns the current row
+    def __init__(self) -> None:
+        super().__init__(10, 1)
+        self.row = "old"
+        self.release = asyncio.Event()
+        self.fetches: List[Hashable] = []
+
+    async def fetch(self, key: Hashable) -> str:
+        self.fetches.append(key)
+        row = self.row
+        await self.release.wait()
+        return row
+
+
+def test_invalidated_during_fetch_is_fetched_again() -> None:
+    async def run() -> None:
+        cache = SlowCache()
+        getting = asyncio.ensure_future(cache.get(1))
+        await asyncio.sleep(0)
+        cache.row = "new"
+        cache.remove(1)  # An invalidation while the old row is being fetched
+        cache.release.set()
+        assert await getting == "new"
+        assert cache.get_nowait(1) == "new"
+        assert len(cache.fetches) == 2
+
+    asyncio.run(run())
+
+
+def test_set_during_fetch_is_kept() -> None:
+    async def run() -> None:
+        cache = SlowCache()
+        getting = asyncio.ensure_future(cache.get(1))
+        await asyncio.sleep(0)
+        cache.set(1, "updated")  # Eg update_prefix while the guild is fetched
+        cache.release.set()
+        assert await getting == "updated"
+        assert cache.get_nowait(1) == "updated"
+        assert len(cache.fetches) == 1
+
+    asyncio.run(run())
+
+
+def test_clear() -> None:
+    cache = BaseLFUCache(10, 1)
+    for key in range(5):
+        cache.set(key, key)
+    cache.clear()
+    assert len(cache) == 0
+    cache.set(1, 1)
+    assert cache.get_nowait(1) == 1
@@ -0,0 +1,93 @@
+# tests/test_component_listeners.py
+
+"""
+Message Manager - A bot for discord
+Copyright (C) 2020-2021 AnotherCat
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+
+from typing import Any
+
+import pytest
+
+from src import component_listeners
+from src.component_listeners import ComponentListeners
+
+
+async def check(interaction: Any) -> bool:
+    return True
+
+
+@pytest.fixture(autouse=True)
+def no_grace(monkeypatch: pytest.MonkeyPatch) -> None:
+    # So the deadlines are only the timeouts the tests give
+    monkeypatch.setattr(component_listeners, "EXPIRY_GRACE", 0)
+
+
+def test_listener_expires() -> None:
+    async def run() -> None:
+        listeners = ComponentListeners()
+        future = asyncio.get_event_loop().create_future()
+        listeners.add(("confirm", "cancel"), future, check, timeout=0.01)
+        assert "confirm" in listeners
+        await asyncio.sleep(0.05)
+        assert future.cancelled()
+        assert len(listeners) == 0
+        assert listeners.expired == 1
+        assert listeners.metrics()["deadlines"] == 0
+
+    asyncio.run(run())
+
+
+def test_listener_is_removed_when_done() -> None:
+    async def run() -> None:
+        listeners = ComponentListeners()
+        future = asyncio.get_event_loop().create_future()
+        listeners.add(("confirm", "cancel"), future, check, timeout=10)
+        future.set_result(None)
+        await asyncio.sleep(0)  # Done callbacks are called soon, not straight away
+        assert len(listeners) == 0
+        assert listeners.get("confirm") is None
+        assert listeners.completed == 1
+        assert listeners.metrics()["pending"] == 0
+
+    asyncio.run(run())
+
+
+def test_cancelled_listener_does_not_expire_a_newer_one() -> None:
+    async def run() -> None:
+        loop = asyncio.get_event_loop()
+        listeners = ComponentListeners()
+        cancelled = loop.create_future()
+        listeners.add(("confirm",), cancelled, check, timeout=0.01)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        # The same custom_id again, the old deadline is still in the heap
+        newer = loop.create_future()
+        listeners.add(("confirm",), newer, check, timeout=10)
+        await asyncio.sleep(0.05)  # Past the cancelled one's deadline
+        assert not newer.done()
+        listener = listeners.get("confirm")
+        assert listener is not None and listener.future is newer
+        assert listeners.expired == 0
+        assert listeners.metrics()["deadlines"] == 1
+        newer.cancel()
+        await asyncio.sleep(0)
+        listeners.compact()
+        assert listeners.metrics()["deadlines"] == 0
+
+    asyncio.run(run())
@@ -0,0 +1,80 @@
+# tests/test_custom_ids.py
+
+"""
+Message Manager - A bot for discord
+Copyright (C) 2020-2021 AnotherCat
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import time
+
+import pytest
+
+from src.custom_ids import (
+    MAX_CUSTOM_ID_LENGTH,
+    CustomIdData,
+    decode_custom_id,
+    encode_custom_id,
+)
+
+MAX_SNOWFLAKE = 2 ** 64 - 1
+
+
+def test_round_trip() -> None:
+    expires_at = int(time.time()) + 60
+    custom_id = encode_custom_id("confirm", 1234, 5678, expires_at)
+    assert decode_custom_id(custom_id) == CustomIdData(
+        "confirm", 1234, 5678, expires_at
+    )
+
+
+def test_tampered_ids_are_rejected() -> None:
+    custom_id = encode_custom_id("confirm", 1234, 5678, time.time() + 60)
+    payload, signature = custom_id.rsplit(".", 1)
+    flipped = ("A" if signature[0] != "A" else "B") + signature[1:]
+    assert decode_custom_id(f"{payload}.{flipped}") is None
+    # Another author, with the signature of the original
+    parts = custom_id.split(".")
+    parts[2] = "zz"
+    assert decode_custom_id(".".join(parts)) is None
+    assert decode_custom_id("confirm") is None
+    assert decode_custom_id("") is None
+
+
+def test_expired_ids_are_expired() -> None:
+    custom_id = encode_custom_id("cancel", 1234, 5678, time.time() - 1)
+    decoded = decode_custom_id(custom_id)
+    assert decoded is not None and decoded.expired
+    custom_id = encode_custom_id("cancel", 1234, 5678, time.time() + 60)
+    decoded = decode_custom_id(custom_id)
+    assert decoded is not None and not decoded.expired
+
+
+def test_expiry_cannot_be_extended() -> None:
+    custom_id = encode_custom_id("cancel", 1234, 5678, time.time() - 1)
+    parts = custom_id.split(".")
+    parts[4] = "zzzzzzz"  # Far in the future
+    assert decode_custom_id(".".join(parts)) is None
+
+
+def test_ids_fit_in_discords_limit() -> None:
+    # The largest ids, with an expiry in the year 3000
+    custom_id = encode_custom_id("confirm", MAX_SNOWFLAKE, MAX_SNOWFLAKE, 32503680000)
+    assert len(custom_id) <= MAX_CUSTOM_ID_LENGTH
+    assert decode_custom_id(custom_id) is not None
+    with pytest.raises(ValueError):
+        encode_custom_id("a" * MAX_CUSTOM_ID_LENGTH, 1, 1, 1)
+    with pytest.raises(ValueError):
+        encode_custom_id("has.dot", 1, 1, 1)
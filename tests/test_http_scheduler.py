@@ -0,0 +1,182 @@
+# tests/test_http_scheduler.py
+
+"""
+Message Manager - A bot for discord
+Copyright (C) 2020-2021 AnotherCat
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+
+from typing import Any, Dict
+
+from src.http_scheduler import (
+    FakeHTTPBackend,
+    FakeRequest,
+    HTTPResponse,
+    HTTPScheduler,
+    Priority,
+)
+
+URL = "https://discord.com/api/v8/channels/1/messages"
+
+
+def limited(limit: int, remaining: int, reset_after: float) -> HTTPResponse:
+    headers = {
+        "X-RateLimit-Limit": str(limit),
+        "X-RateLimit-Remaining": str(remaining),
+        "X-RateLimit-Reset-After": str(reset_after),
+    }
+    return HTTPResponse(200, "OK", headers, {})
+
+
+class CountingBackend(FakeHTTPBackend):
+    # Keeps the most requests that were in flight at once
+    def __init__(self, response: HTTPResponse, latency: float) -> None:
+        super().__init__(handler=lambda request: response, latency=latency)
+        self.in_flight = 0
+        self.peak = 0
+
+    async def request(
+        self, method: str, url: str, *, headers: Dict[str, str], data: Any = None
+    ) -> HTTPResponse:
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        try:
+            return await super().request(method, url, headers=headers, data=data)
+        finally:
+            self.in_flight -= 1
+
+
+def send(
+    scheduler: HTTPScheduler, priority: Priority = Priority.MESSAGE, json: Any = None
+) -> "asyncio.Future[Any]":
+    return asyncio.ensure_future(
+        scheduler.request("POST", URL, bucket="messages", priority=priority, json=json)
+    )
+
+
+def test_learns_limit_from_headers() -> None:
+    async def run() -> None:
+        scheduler = HTTPScheduler(FakeHTTPBackend(lambda r: limited(5, 3, 2)), None)
+        await send(scheduler)
+        bucket = scheduler.buckets["messages"]
+        assert bucket.limit == 5
+        assert bucket.remaining == 3
+        assert not bucket.unlimited
+
+    asyncio.run(run())
+
+
+def test_routes_without_headers_are_unlimited() -> None:
+    async def run() -> None:
+        backend = CountingBackend(HTTPResponse(200, "OK", {}, {}), latency=0.01)
+        scheduler = HTTPScheduler(backend, None)
+        await send(scheduler)
+        await asyncio.gather(*(send(scheduler) for _ in range(10)))
+        assert scheduler.buckets["messages"].unlimited
+        assert backend.peak == 10
+
+    asyncio.run(run())
+
+
+def test_retries_after_429() -> None:
+    async def run() -> None:
+        backend = FakeHTTPBackend()
+        backend.add_response(429, {"retry_after": 5}, {"Retry-After": "0.05"})
+        scheduler = HTTPScheduler(backend, None)
+        assert await send(scheduler) == {}
+        assert len(backend.requests) == 2
+        assert scheduler.rate_limited == 1
+        # The header is used over the body
+        gap = backend.requests[1].sent_at - backend.requests[0].sent_at
+        assert 0.05 <= gap < 1
+
+    asyncio.run(run())
+
+
+def test_waiters_go_in_priority_order() -> None:
+    async def run() -> None:
+        def handler(request: FakeRequest) -> HTTPResponse:
+            return limited(1, 0, 0.01)
+
+        backend = FakeHTTPBackend(handler, latency=0.01)
+        scheduler = HTTPScheduler(backend, None)
+        first = send(scheduler, json={"order": "first"})
+        await asyncio.sleep(0)  # Takes the only token
+        waiting = [
+            send(scheduler, priority, json={"order": priority.name})
+            for priority in (Priority.WEBHOOK, Priority.MESSAGE, Priority.INTERACTION)
+        ]
+        await asyncio.gather(first, *waiting)
+        assert [request.data for request in backend.requests] == [
+            '{"order":"first"}',
+            '{"order":"INTERACTION"}',
+            '{"order":"MESSAGE"}',
+            '{"order":"WEBHOOK"}',
+        ]
+
+    asyncio.run(run())
+
+
+def test_no_burst_after_reset() -> None:
+    async def run() -> None:
+        backend = CountingBackend(limited(2, 0, 0.05), latency=0.01)
+        scheduler = HTTPScheduler(backend, None)
+        await send(scheduler)
+        await asyncio.sleep(0.1)  # Past the reset the response gave
+        await asyncio.gather(*(send(scheduler) for _ in range(20)))
+        assert backend.peak == 2
+        assert len(backend.requests) == 21
+
+    asyncio.run(run())
+
+
+def test_cancelled_while_waiting_on_global_gives_token_back() -> None:
+    async def run() -> None:
+        scheduler = HTTPScheduler(FakeHTTPBackend(), None, global_limit=1)
+        await scheduler.request(
+            "POST", URL, bucket="other", priority=Priority.MESSAGE
+        )  # Uses the only global token for this second
+        cancelled = send(scheduler)
+        await asyncio.sleep(0)  # Has the route token, waits on the global one
+        assert scheduler.buckets["messages"].remaining == 0
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        assert scheduler.buckets["messages"].remaining == 1
+        assert await asyncio.wait_for(send(scheduler), 2) == {}
+
+    asyncio.run(run())
+
+
+def test_idle_buckets_are_pruned() -> None:
+    async def run() -> None:
+        scheduler = HTTPScheduler(FakeHTTPBackend(latency=0.01), None)
+        for interaction_id in range(10):
+            await scheduler.request(
+                "POST",
+                URL,
+                bucket=f"interaction:{interaction_id}",
+                priority=Priority.INTERACTION,
+            )
+        pending = send(scheduler)
+        await asyncio.sleep(0)
+        scheduler.prune(asyncio.get_event_loop().time())
+        # Only the one with a request still in flight is kept
+        assert list(scheduler.buckets) == ["messages"]
+        assert scheduler.pruned == 10
+        await pending
+
+    asyncio.run(run())
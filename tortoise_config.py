@@ -1,9 +1,27 @@
-from load_config import uri
+import load_config
 
 TORTOISE_ORM = {
     "connections": {
-        # Using a DB_URL string
-        "default": uri
+        "default": {
+            # AsyncpgDBClient with pool metrics
+            "engine": "src.db",
+            "credentials": {
+                "host": "postgres",
+                "port": 5432,
+                "user": load_config.postgres_user,
+                "password": load_config.postgres_password,
+                "database": load_config.postgres_db,
+                "minsize": load_config.db_pool_min,
+                "maxsize": load_config.db_pool_max,
+                "max_inactive_connection_lifetime": load_config.db_connection_lifetime,
+                "server_settings": {
+                    # In milliseconds, 0 is no timeout
+                    "statement_timeout": str(
+                        int(load_config.db_statement_timeout * 1000)
+                    ),
+                },
+            },
+        }
     },
     "apps": {
         "bot": {